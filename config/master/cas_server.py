@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# Receives build artifacts from the slaves outside of the buildbot process.
+#
+# Blobs are stored once by their sha256 under STORE and published by hard
+# linking them to ROOT/<directory>/<name>, so the existing download URLs keep
+# working.  ROOT is served to the public, so STORE, with its half-uploaded files
+# and working copy snapshots, has to be outside of it but on the same
+# filesystem mount.  The protocol is:
+#
+#   HEAD /blobs/<sha256>  200 if the blob is stored.  Otherwise 404 with an
+#                         Upload-Offset header saying how many bytes of an
+#                         interrupted upload the server already has.
+#   GET /blobs/<sha256>   Downloads a stored blob.
+#   PUT /blobs/<sha256>   Upload-Offset and Upload-Length headers, the body is
+#                         the rest of the file from that offset.
+#   POST /links/<directory>/<name>
+#                         The body is the sha256 of a stored blob.
+#   GET /snapshots/<slave>
+#                         A JSON object with the metadata of the slave's
+#                         working copy snapshots by builddir.
+#   PUT /snapshots/<slave>/<builddir>
+#                         The body is the snapshot's JSON metadata, whose
+#                         sha256 is a stored blob.  Replaces the builddir's
+#                         last snapshot, whose blob is removed unless it's
+#                         published somewhere.
+#
+# PUT and POST need an "Authorization: Bearer <token>" header with the token
+# in --token-file.  Without the file nothing can be uploaded.
+
+import argparse
+import BaseHTTPServer
+import contextlib
+import errno
+import hashlib
+import hmac
+import json
+import os
+import re
+import SocketServer
+import threading
+import time
+
+CHUNK_SIZE = 1024 * 1024
+# How long a second upload of a blob waits for the first one to finish.
+UPLOAD_WAIT = 4 * 60  # seconds
+UPLOAD_POLL_INTERVAL = 0.5  # seconds
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+COMPONENT_RE = re.compile(r'^[A-Za-z0-9_+~-][A-Za-z0-9._+~-]*$')
+
+
+def MakeDirs(path):
+  try:
+    os.makedirs(path)
+  except OSError as ex:
+    if ex.errno != errno.EEXIST:
+      raise
+
+
+class Store(object):
+  def __init__(self, root, storedir):
+    self.root = root
+    # Where the store used to be, inside the published tree.
+    if (os.path.isdir(os.path.join(root, '.cas')) and
+        not os.path.exists(storedir)):
+      os.rename(os.path.join(root, '.cas'), storedir)
+    self.blobdir = os.path.join(storedir, 'blobs')
+    self.partialdir = os.path.join(storedir, 'partial')
+    self.snapshotdir = os.path.join(storedir, 'snapshots')
+    MakeDirs(self.blobdir)
+    MakeDirs(self.partialdir)
+    MakeDirs(self.snapshotdir)
+    MakeDirs(root)
+    self.CheckLinkable()
+
+    self.locks_lock = threading.Lock()
+    self.locks = {}
+    self.snapshots_lock = threading.Lock()
+
+  def CheckLinkable(self):
+    """Fails straight away if blobs can't be hard linked into the root."""
+    source = os.path.join(self.partialdir, '.link-check')
+    dest = os.path.join(self.root, '.link-check')
+    open(source, 'w').close()
+    try:
+      if os.path.exists(dest):
+        os.unlink(dest)
+      os.link(source, dest)
+      os.unlink(dest)
+    finally:
+      os.unlink(source)
+
+  def BlobPath(self, sha256):
+    return os.path.join(self.blobdir, sha256[:2], sha256)
+
+  def PartialPath(self, sha256):
+    return os.path.join(self.partialdir, sha256)
+
+  def Snapshots(self, slave):
+    directory = os.path.join(self.snapshotdir, slave)
+    snapshots = {}
+    if os.path.isdir(directory):
+      for filename in os.listdir(directory):
+        if filename.endswith('.json'):
+          with open(os.path.join(directory, filename)) as fh:
+            snapshots[filename[:-len('.json')]] = json.load(fh)
+    return snapshots
+
+  def SaveSnapshot(self, slave, builddir, info):
+    """Links the snapshot's blob next to its metadata, so the blob's link
+    count says whether anything still uses it."""
+    base = os.path.join(self.snapshotdir, slave, builddir)
+    MakeDirs(os.path.dirname(base))
+    with self.snapshots_lock:
+      old = None
+      if os.path.exists(base + '.json'):
+        with open(base + '.json') as fh:
+          old = json.load(fh).get('sha256')
+
+      if os.path.exists(base + '.tmp'):
+        os.unlink(base + '.tmp')
+      os.link(self.BlobPath(info['sha256']), base + '.tmp')
+      os.rename(base + '.tmp', base + '.tar.gz')
+      with open(base + '.json.tmp', 'w') as fh:
+        json.dump(info, fh)
+      os.rename(base + '.json.tmp', base + '.json')
+
+      if old and old != info['sha256']:
+        blob = self.BlobPath(old)
+        if os.path.exists(blob) and os.stat(blob).st_nlink == 1:
+          os.unlink(blob)
+
+  @contextlib.contextmanager
+  def Lock(self, sha256):
+    """Holds the upload lock of sha256, waiting up to UPLOAD_WAIT for it.
+
+    Only one upload of the same blob can append to its partial file.  Yields
+    whether the lock was acquired.  The lock is forgotten once nobody is
+    waiting for it.
+    """
+    with self.locks_lock:
+      entry = self.locks.setdefault(sha256, [threading.Lock(), 0])
+      entry[1] += 1
+    lock = entry[0]
+
+    deadline = time.time() + UPLOAD_WAIT
+    acquired = lock.acquire(False)
+    while not acquired and time.time() < deadline:
+      time.sleep(UPLOAD_POLL_INTERVAL)
+      acquired = lock.acquire(False)
+    try:
+      yield acquired
+    finally:
+      if acquired:
+        lock.release()
+      with self.locks_lock:
+        entry[1] -= 1
+        if not entry[1]:
+          del self.locks[sha256]
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def _Reply(self, code, body='', headers=None):
+    self.send_response(code)
+    for key, value in (headers or {}).iteritems():
+      self.send_header(key, str(value))
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    if self.command != 'HEAD':
+      self.wfile.write(body)
+
+  def _Authorized(self):
+    token = self.server.token
+    header = self.headers.get('Authorization', '')
+    if token and hmac.compare_digest(header, 'Bearer ' + token):
+      return True
+    self.close_connection = True
+    self._Reply(403, 'Bad or missing upload token\n')
+    return False
+
+  def _Discard(self, length):
+    while length:
+      data = self.rfile.read(min(CHUNK_SIZE, length))
+      if not data:
+        break
+      length -= len(data)
+
+  def _Sha256(self):
+    match = re.match(r'^/blobs/([0-9a-f]{64})$', self.path)
+    return match.group(1) if match else None
+
+  def do_HEAD(self):
+    store = self.server.store
+    sha256 = self._Sha256()
+    if sha256 is None:
+      return self._Reply(400)
+
+    blob = store.BlobPath(sha256)
+    if os.path.exists(blob):
+      return self._Reply(200, headers={'Upload-Length': os.path.getsize(blob)})
+
+    partial = store.PartialPath(sha256)
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    self._Reply(404, headers={'Upload-Offset': offset})
+
+  def do_GET(self):
+    store = self.server.store
+    components = self.path.split('/')[1:]
+    if components[:1] == ['snapshots']:
+      if len(components) != 2 or not COMPONENT_RE.match(components[1]):
+        return self._Reply(400, 'Bad snapshot request\n')
+      return self._Reply(200, json.dumps(store.Snapshots(components[1])),
+                         {'Content-Type': 'application/json'})
+
+    sha256 = self._Sha256()
+    if sha256 is None or not os.path.exists(store.BlobPath(sha256)):
+      return self._Reply(404, 'No blob\n')
+
+    with open(store.BlobPath(sha256), 'rb') as fh:
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/octet-stream')
+      self.send_header('Content-Length', str(os.fstat(fh.fileno()).st_size))
+      self.end_headers()
+      for chunk in iter(lambda: fh.read(CHUNK_SIZE), ''):
+        self.wfile.write(chunk)
+
+  def do_PUT(self):
+    if not self._Authorized():
+      return
+    store = self.server.store
+    if self.path.startswith('/snapshots/'):
+      return self._PutSnapshot(store)
+    sha256 = self._Sha256()
+    try:
+      offset = int(self.headers['Upload-Offset'])
+      total = int(self.headers['Upload-Length'])
+      length = int(self.headers['Content-Length'])
+    except (KeyError, TypeError, ValueError):
+      sha256 = None
+    if sha256 is None:
+      self.close_connection = True
+      return self._Reply(400, 'Bad upload request\n')
+
+    with store.Lock(sha256) as acquired:
+      if not acquired:
+        self.close_connection = True
+        return self._Reply(409, 'Still uploading %s\n' % sha256)
+      self._Upload(store, sha256, offset, total, length)
+
+  def _Upload(self, store, sha256, offset, total, length):
+    blob = store.BlobPath(sha256)
+    if os.path.exists(blob):
+      # Also the case when another upload of the blob finished while this one
+      # waited for it.
+      self._Discard(length)
+      return self._Reply(200, 'Already stored\n')
+
+    partial = store.PartialPath(sha256)
+    have = os.path.getsize(partial) if os.path.exists(partial) else 0
+    if offset > have or offset + length > total:
+      self.close_connection = True
+      return self._Reply(409, 'Bad offset\n', {'Upload-Offset': have})
+
+    # The hash state can't be saved between requests, so the bytes received
+    # by an earlier attempt are hashed again before the new ones.
+    digest = hashlib.sha256()
+    with open(partial, 'ab+') as fh:
+      fh.truncate(offset)
+      fh.seek(0)
+      while fh.tell() < offset:
+        digest.update(fh.read(min(CHUNK_SIZE, offset - fh.tell())))
+
+      remaining = length
+      while remaining:
+        data = self.rfile.read(min(CHUNK_SIZE, remaining))
+        if not data:
+          # The slave went away, keep what we have so it can resume.
+          self.close_connection = True
+          return
+        digest.update(data)
+        fh.write(data)
+        remaining -= len(data)
+
+    if offset + length < total:
+      return self._Reply(202, headers={'Upload-Offset': offset + length})
+
+    if digest.hexdigest() != sha256:
+      os.unlink(partial)
+      return self._Reply(422, 'Content does not match %s\n' % sha256)
+
+    MakeDirs(os.path.dirname(blob))
+    os.chmod(partial, 0644)
+    os.rename(partial, blob)
+    self._Reply(201, 'Stored %s\n' % sha256)
+
+  def _PutSnapshot(self, store):
+    length = int(self.headers.get('Content-Length', 0))
+    try:
+      info = json.loads(self.rfile.read(length))
+      sha256 = str(info['sha256'])
+    except (ValueError, KeyError, TypeError):
+      sha256 = None
+
+    components = self.path.split('/')[1:]
+    if (len(components) != 3 or not SHA256_RE.match(sha256 or '') or
+        not all(COMPONENT_RE.match(x) for x in components[1:])):
+      return self._Reply(400, 'Bad snapshot request\n')
+    if not os.path.exists(store.BlobPath(sha256)):
+      return self._Reply(404, 'No blob %s\n' % sha256)
+
+    store.SaveSnapshot(components[1], components[2], info)
+    self._Reply(201, '/'.join(components[1:]) + '\n')
+
+  def do_POST(self):
+    if not self._Authorized():
+      return
+    store = self.server.store
+    length = int(self.headers.get('Content-Length', 0))
+    sha256 = self.rfile.read(length).strip()
+
+    components = self.path.split('/')[1:]
+    if (len(components) < 3 or components[0] != 'links' or
+        not SHA256_RE.match(sha256) or
+        not all(COMPONENT_RE.match(x) for x in components[1:])):
+      return self._Reply(400, 'Bad link request\n')
+
+    blob = store.BlobPath(sha256)
+    if not os.path.exists(blob):
+      return self._Reply(404, 'No blob %s\n' % sha256)
+
+    dest = os.path.join(store.root, *components[1:])
+    temp = '%s.%s.tmp' % (dest, sha256[:12])
+    MakeDirs(os.path.dirname(dest))
+    if os.path.exists(temp):
+      os.unlink(temp)
+    os.link(blob, temp)
+    # rename() does nothing if dest is already a link to the same blob.
+    os.rename(temp, dest)
+    if os.path.exists(temp):
+      os.unlink(temp)
+    self._Reply(201, '/'.join(components[1:]) + '\n')
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--root', required=True,
+                      help='Published directory that blobs are linked into')
+  parser.add_argument('--store', required=True,
+                      help='Private directory on the same mount as --root')
+  parser.add_argument('--port', type=int, default=8011)
+  parser.add_argument('--token-file', required=True,
+                      help='File with the token that uploads must send')
+  args = parser.parse_args()
+
+  server = Server(('', args.port), Handler)
+  server.store = Store(args.root, args.store)
+  server.token = None
+  if os.path.exists(args.token_file):
+    server.token = open(args.token_file).read().strip() or None
+  else:
+    print '%s is missing, uploads are refused' % args.token_file
+  server.serve_forever()
+
+
+if __name__ == '__main__':
+  main()
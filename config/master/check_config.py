@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# Loads master.cfg.py without buildbot or twisted and checks the result.  The
+# buildbot and twisted modules are replaced by stubs that remember how they
+# were constructed, and the config files are read from --config-dir, which
+# defaults to the fixtures next to this script.
+#
+# Prints how long the config took to load, which slaves, locks and schedulers
+# each builder uses, and anything that buildbot would reject or that looks
+# wrong.  Exits with 1 if there were errors.
+
+import argparse
+import collections
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+import types
+
+MASTER_DIR = os.path.dirname(os.path.abspath(__file__))
+STUBBED_PACKAGES = ('buildbot', 'twisted', 'zope')
+
+
+class Recorder(object):
+  """Keeps the arguments an object was created with."""
+
+  compare_attrs = []
+  renderables = []
+
+  def __new__(cls, *args, **kwargs):
+    obj = object.__new__(cls)
+    obj.stub_args = args
+    obj.stub_kwargs = dict(kwargs)
+    return obj
+
+  def __init__(self, *args, **kwargs):
+    pass
+
+
+class Stub(Recorder):
+  """Stands in for any buildbot or twisted object.
+
+  Any attribute of it is another stub, so config code can call methods on it.
+  Called with just a function, it returns the function so it works as a
+  decorator.
+  """
+
+  def __getattr__(self, name):
+    if name.startswith('__'):
+      raise AttributeError(name)
+    return Stub()
+
+  def __call__(self, *args, **kwargs):
+    if len(args) == 1 and callable(args[0]) and not kwargs:
+      return args[0]
+    return Stub()
+
+  def __iter__(self):
+    return iter([])
+
+
+class StubModule(types.ModuleType):
+  """A module whose capitalised attributes are Stub subclasses, one per name,
+  and whose other attributes are submodules."""
+
+  def __init__(self, name):
+    types.ModuleType.__init__(self, name)
+    self.__path__ = []
+
+  def __getattr__(self, name):
+    if name.startswith('__'):
+      raise AttributeError(name)
+    if name[0].isupper():
+      cls = type(name, (Stub,), {'__module__': self.__name__})
+      setattr(self, name, cls)
+      return cls
+    return __import__('%s.%s' % (self.__name__, name), fromlist=['_'])
+
+  def __call__(self, *args, **kwargs):
+    return Stub.__call__.im_func(self, *args, **kwargs)
+
+
+class StubImporter(object):
+
+  def find_module(self, name, path=None):
+    if name.split('.')[0] in STUBBED_PACKAGES:
+      return self
+    return None
+
+  def load_module(self, name):
+    if name in sys.modules:
+      return sys.modules[name]
+    module = StubModule(name)
+    module.__loader__ = self
+    sys.modules[name] = module
+    parent, _, child = name.rpartition('.')
+    if parent:
+      setattr(__import__(parent, fromlist=['_']), child, module)
+    return module
+
+
+class StepFactory(object):
+  """Like buildbot's _BuildStepFactory, which factories may change."""
+
+  def __init__(self, factory, args, kwargs):
+    self.factory = factory
+    self.args = args
+    self.kwargs = kwargs
+
+
+def IBuildStepFactory(step):
+  return StepFactory(type(step), step.stub_args, step.stub_kwargs)
+
+
+class BuildFactory(Recorder):
+
+  def __init__(self, steps=None):
+    self.steps = []
+    for step in steps or []:
+      self.addStep(step)
+
+  def addStep(self, step):
+    self.steps.append(IBuildStepFactory(step))
+
+  def addSteps(self, steps):
+    for step in steps:
+      self.addStep(step)
+
+
+class BuildSlave(Recorder):
+
+  def __init__(self, name, password, **kwargs):
+    self.slavename = name
+
+
+class AbstractLatentBuildSlave(BuildSlave):
+  pass
+
+
+class BaseLock(Recorder):
+
+  def __init__(self, name, maxCount=1):
+    self.name = name
+    self.maxCount = maxCount
+
+
+class MasterLock(Recorder):
+
+  compare_attrs = ['name', 'maxCount']
+
+  def __init__(self, name, maxCount=1):
+    self.name = name
+    self.maxCount = maxCount
+
+  def access(self, mode):
+    return LockAccess(self, mode)
+
+  def defaultAccess(self):
+    return self.access('counting')
+
+
+class SlaveLock(MasterLock):
+
+  def __init__(self, name, maxCount=1, maxCountForSlave=None):
+    MasterLock.__init__(self, name, maxCount)
+    self.maxCountForSlave = maxCountForSlave or {}
+
+
+class LockAccess(Recorder):
+
+  compare_attrs = ['lockid', 'mode']
+
+  def __init__(self, lockid, mode, _skipChecks=False):
+    self.lockid = lockid
+    self.mode = mode
+
+
+def InstallStubs():
+  sys.meta_path.insert(0, StubImporter())
+
+  from buildbot import buildslave
+  from buildbot import interfaces
+  from buildbot import locks
+  from buildbot.process import factory
+  from twisted.internet import defer
+  buildslave.AbstractLatentBuildSlave = AbstractLatentBuildSlave
+  buildslave.BuildSlave = BuildSlave
+  interfaces.IBuildStepFactory = IBuildStepFactory
+  locks.BaseLock = BaseLock
+  locks.MasterLock = MasterLock
+  locks.SlaveLock = SlaveLock
+  locks.LockAccess = LockAccess
+  factory.BuildFactory = BuildFactory
+  defer.inlineCallbacks = lambda f: f
+  defer.returnValue = lambda value: None
+
+
+def LoadConfig(config_dir):
+  """Runs master.cfg.py like buildbot does and returns its
+  BuildmasterConfig."""
+  os.environ['CLEMENTINE_CONFIG_DIR'] = config_dir
+  sys.path.insert(0, MASTER_DIR)
+
+  basedir = tempfile.mkdtemp()
+  try:
+    # Keeps master.cfg.py from dumping the config.
+    open(os.path.join(basedir, 'quiet-config'), 'w').close()
+    filename = os.path.join(MASTER_DIR, 'master.cfg.py')
+    namespace = {'basedir': basedir, '__file__': filename}
+    execfile(filename, namespace)
+  finally:
+    shutil.rmtree(basedir)
+  return namespace['BuildmasterConfig']
+
+
+def LockName(access):
+  lock = access.lockid
+  kind = 'slave' if isinstance(lock, SlaveLock) else 'master'
+  return '%s (%s lock, max %s)' % (lock.name, kind, lock.maxCount)
+
+
+def LockUse(access):
+  weight = getattr(access, 'weight', None)
+  if weight is not None:
+    return 'weight %s' % weight
+  return access.mode
+
+
+class Checker(object):
+
+  def __init__(self, config):
+    self.config = config
+    self.errors = []
+    self.warnings = []
+
+  def Error(self, message):
+    self.errors.append(message)
+
+  def Warning(self, message):
+    self.warnings.append(message)
+
+  def Check(self):
+    builders = self.config['builders']
+    slave_names = [x.slavename for x in self.config['slaves']]
+    builder_names = [x['name'] for x in builders]
+    scheduler_names = [x.stub_kwargs.get('name') for x in
+                       self.config['schedulers']]
+
+    for kind, names in [('slave', slave_names), ('builder', builder_names),
+                        ('builddir', [x['builddir'] for x in builders]),
+                        ('scheduler', scheduler_names)]:
+      for name, count in collections.Counter(names).iteritems():
+        if count > 1:
+          self.Error('%s %r is defined %d times' % (kind, name, count))
+
+    used_slaves = set()
+    for builder in builders:
+      used_slaves.add(builder['slavename'])
+      if builder['slavename'] not in slave_names:
+        self.Error('builder %r uses unknown slave %r' % (
+            builder['name'], builder['slavename']))
+      if not builder['factory'].steps:
+        self.Error('builder %r has no steps' % builder['name'])
+      for access in builder.get('locks', []):
+        weight = getattr(access, 'weight', None)
+        if weight is not None and weight > access.lockid.maxCount:
+          self.Error('builder %r needs %s of lock %r, which only has %s' % (
+              builder['name'], weight, access.lockid.name,
+              access.lockid.maxCount))
+      self._CheckTriggers(builder, scheduler_names)
+
+    for name in slave_names:
+      if name not in used_slaves:
+        self.Warning('slave %r has no builders' % name)
+
+    scheduled = set()
+    for scheduler in self.config['schedulers']:
+      names = scheduler.stub_kwargs.get('builderNames', [])
+      scheduled.update(names)
+      for name in names:
+        if name not in builder_names:
+          self.Error('scheduler %r uses unknown builder %r' % (
+              scheduler.stub_kwargs.get('name'), name))
+
+    for name in builder_names:
+      if name not in scheduled:
+        self.Warning('builder %r is never scheduled' % name)
+
+  def _CheckTriggers(self, builder, scheduler_names):
+    for step in builder['factory'].steps:
+      if step.factory.__name__ != 'Trigger':
+        continue
+      for name in step.kwargs.get('schedulerNames', []):
+        if name not in scheduler_names:
+          self.Error('builder %r triggers unknown scheduler %r' % (
+              builder['name'], name))
+
+
+def PrintGraphs(config):
+  print 'Builders:'
+  for builder in config['builders']:
+    print '  %s' % builder['name']
+    print '    slave: %s' % builder['slavename']
+    print '    steps: %d' % len(builder['factory'].steps)
+    for access in builder.get('locks', []):
+      print '    lock:  %s, %s' % (access.lockid.name, LockUse(access))
+
+  print
+  print 'Slaves:'
+  by_slave = collections.defaultdict(list)
+  for builder in config['builders']:
+    by_slave[builder['slavename']].append(builder['name'])
+  for slave in config['slaves']:
+    latent = ' (latent)' if isinstance(slave, AbstractLatentBuildSlave) else ''
+    print '  %s%s: %s' % (slave.slavename, latent,
+                          ', '.join(by_slave[slave.slavename]) or '-')
+
+  print
+  print 'Locks:'
+  by_lock = collections.OrderedDict()
+  for builder in config['builders']:
+    for access in builder.get('locks', []):
+      by_lock.setdefault(LockName(access), []).append(
+          '%s (%s)' % (builder['name'], LockUse(access)))
+  for lock, users in by_lock.iteritems():
+    print '  %s:' % lock
+    for user in users:
+      print '    %s' % user
+
+  print
+  print 'Schedulers:'
+  for scheduler in config['schedulers']:
+    print '  %s (%s): %s' % (
+        scheduler.stub_kwargs.get('name'), type(scheduler).__name__,
+        ', '.join(scheduler.stub_kwargs.get('builderNames', [])) or '-')
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--config-dir',
+                      default=os.path.join(MASTER_DIR, 'fixtures'),
+                      help='Directory with config.json and the passwords')
+  parser.add_argument('--summary', action='store_true',
+                      help="Don't print the builder, slave and lock graphs")
+  args = parser.parse_args()
+
+  InstallStubs()
+  start = time.time()
+  try:
+    config = LoadConfig(os.path.abspath(args.config_dir))
+  except Exception:
+    traceback.print_exc()
+    sys.exit('master.cfg.py failed to load')
+  elapsed = time.time() - start
+
+  print 'Loaded master.cfg.py in %.2fs' % elapsed
+  print
+
+  if not args.summary:
+    PrintGraphs(config)
+    print
+
+  checker = Checker(config)
+  checker.Check()
+  for warning in checker.warnings:
+    print 'warning: %s' % warning
+  for error in checker.errors:
+    print 'error: %s' % error
+  if checker.errors:
+    sys.exit(1)
+  print 'No errors'
+
+
+if __name__ == '__main__':
+  main()
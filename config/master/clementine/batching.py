@@ -0,0 +1,166 @@
+from buildbot import util
+from buildbot.db import buildrequests
+from buildbot.process.properties import Properties
+from buildbot.schedulers import basic
+from buildbot.status import results
+from twisted.internet import defer
+from twisted.python import log
+
+
+class AdaptiveScheduler(basic.SingleBranchScheduler):
+  """A SingleBranchScheduler that waits longer for the tree to settle when
+  it's busy.
+
+  The tree stable timer starts at minStableTimer and grows with the number of
+  commits that arrived in the last rateWindow seconds and the number of
+  requests already waiting for the builders, up to maxStableTimer.
+
+  When a batch is queued, the requests of this scheduler's earlier batches that
+  haven't started yet are retired, since the new one builds a newer revision.
+  Each batch's buildset gets a batch-changes property with the revisions it
+  covers, including those of the buildsets it replaced, and batch-superseded
+  with the replaced buildsets.
+
+  With a pathrules.ChangeClassifier, changes that no builder needs are
+  unimportant, and each batch only queues the builders its changes need.
+  """
+
+  compare_attrs = basic.SingleBranchScheduler.compare_attrs + [
+      "minStableTimer", "maxStableTimer", "rateWindow", "classifier"]
+
+  # Seconds added to the timer for each recent commit and for each request
+  # that's queued per builder.
+  PER_CHANGE = 30
+  PER_REQUEST = 60
+
+  def __init__(self, name, minStableTimer=30, maxStableTimer=15 * 60,
+               rateWindow=30 * 60, classifier=None, **kwargs):
+    if classifier is not None:
+      kwargs.setdefault("fileIsImportant", classifier)
+    basic.SingleBranchScheduler.__init__(
+        self, name, treeStableTimer=minStableTimer, **kwargs)
+    self.minStableTimer = minStableTimer
+    self.maxStableTimer = maxStableTimer
+    self.rateWindow = rateWindow
+    self.classifier = classifier
+    self.change_times = {}
+
+  @defer.inlineCallbacks
+  def _PendingRequests(self, builder_names=None):
+    pending = []
+    for buildername in builder_names or self.builderNames:
+      requests = yield self.master.db.buildrequests.getBuildRequests(
+          buildername=buildername, claimed=False)
+      pending.extend(requests)
+    defer.returnValue(pending)
+
+  @defer.inlineCallbacks
+  def StableTimer(self):
+    now = util.now(self._reactor)
+    for number, when in self.change_times.items():
+      if when < now - self.rateWindow:
+        del self.change_times[number]
+
+    # The change that started the timer doesn't count.
+    recent = max(0, len(self.change_times) - 1)
+    pending = yield self._PendingRequests()
+    queued = float(len(pending)) / max(1, len(self.builderNames))
+
+    timer = (self.minStableTimer + self.PER_CHANGE * recent +
+             self.PER_REQUEST * queued)
+    defer.returnValue(int(min(self.maxStableTimer, timer)))
+
+  @util.deferredLocked("_stable_timers_lock")
+  @defer.inlineCallbacks
+  def gotChange(self, change, important):
+    # Same as BaseBasicScheduler.gotChange, but the timer's length is worked
+    # out for every change.
+    timer_name = self.getTimerNameForChange(change)
+    yield self.master.db.schedulers.classifyChanges(
+        self.objectid, {change.number: important})
+    if not important and not self._stable_timers[timer_name]:
+      return
+
+    if important:
+      self.change_times[change.number] = util.now(self._reactor)
+    timer = yield self.StableTimer()
+    if self._stable_timers[timer_name]:
+      self._stable_timers[timer_name].cancel()
+
+    def FireTimer():
+      d = self.stableTimerFired(timer_name)
+      d.addErrback(log.err, "while firing stable timer")
+    self._stable_timers[timer_name] = self._reactor.callLater(timer, FireTimer)
+    log.msg("%s: waiting %ds for the tree to be stable" % (self.name, timer))
+
+  @defer.inlineCallbacks
+  def _SupersededRequests(self, builder_names):
+    """Returns this scheduler's requests for the builders that haven't started
+    yet, and the revisions their buildsets were for."""
+    superseded = []
+    revisions = {}
+    for request in (yield self._PendingRequests(builder_names)):
+      properties = yield self.master.db.buildsets.getBuildsetProperties(
+          request["buildsetid"])
+      if properties.get("scheduler", (None,))[0] != self.name:
+        continue
+      superseded.append(request)
+      revisions[request["buildsetid"]] = properties.get(
+          "batch-changes", ([],))[0]
+    defer.returnValue((superseded, revisions))
+
+  @defer.inlineCallbacks
+  def _RetireRequest(self, request):
+    try:
+      yield self.master.db.buildrequests.claimBuildRequests(
+          [request["brid"]])
+    except buildrequests.AlreadyClaimedError:
+      # It started in the meantime.
+      return
+    yield self.master.db.buildrequests.completeBuildRequests(
+        [request["brid"]], results.SKIPPED)
+    yield self.master.maybeBuildsetComplete(request["buildsetid"])
+
+  @defer.inlineCallbacks
+  def addBuildsetForChanges(self, reason="", external_idstring=None,
+                            changeids=[], builderNames=None, properties=None):
+    chdicts = []
+    for changeid in changeids:
+      chdict = yield self.master.db.changes.getChange(changeid)
+      chdicts.append(chdict)
+
+    if builderNames is None and self.classifier is not None:
+      files = []
+      # A change without a file list needs every builder, and so does an
+      # empty list of files.
+      if all(x["files"] for x in chdicts):
+        files = sum((x["files"] for x in chdicts), [])
+      builderNames = self.classifier.Builders(files)
+      log.msg("%s: changes %s need %s" % (self.name, changeids, builderNames))
+      if not builderNames:
+        return
+    builderNames = builderNames or self.builderNames
+
+    superseded, superseded_revisions = yield self._SupersededRequests(
+        builderNames)
+
+    revisions = []
+    for bsid in sorted(superseded_revisions):
+      revisions.extend(superseded_revisions[bsid])
+    revisions.extend(x["revision"] for x in chdicts)
+
+    properties = properties or Properties()
+    properties.setProperty("batch-changes", revisions, "AdaptiveScheduler")
+    properties.setProperty(
+        "batch-superseded", sorted(superseded_revisions), "AdaptiveScheduler")
+
+    rv = yield basic.SingleBranchScheduler.addBuildsetForChanges(
+        self, reason=reason, external_idstring=external_idstring,
+        changeids=changeids, builderNames=builderNames, properties=properties)
+
+    for request in superseded:
+      yield self._RetireRequest(request)
+    if superseded:
+      log.msg("%s: %d queued requests replaced by buildset %s" % (
+          self.name, len(superseded), rv[0]))
+    defer.returnValue(rv)
@@ -1,82 +1,1062 @@
+import collections
+import hashlib
+import json
+import os
 import os.path
+import re
+import stat
+import time
+
+from distutils.version import LooseVersion
 
 from buildbot.changes import gitpoller
+from buildbot import interfaces
 from buildbot.plugins import util
+from buildbot.process import buildstep
 from buildbot.process import factory
 from buildbot.steps import master
 from buildbot.steps import shell
-from buildbot.steps import transfer
+from buildbot.steps import trigger
 from buildbot.steps.source import git
+from twisted.internet import defer
+from twisted.internet import utils
+from twisted.python import log
+from twisted.web import client
 
 SPOTIFYBASE = "/var/www/clementine-player.org/spotify"
 UPLOADBASE = "/var/www/clementine-player.org/builds"
 UPLOADURL = "http://builds.clementine-player.org"
+CASUPLOADSCRIPT = "/config/slave/cas_upload.py"
+CASFETCHSCRIPT = "/config/slave/cas_fetch.py"
+SNAPSHOTSCRIPT = "/config/slave/snapshot.py"
+PROFILESCRIPT = "/config/slave/profile.py"
+UPDATETREESCRIPT = "/config/slave/update_tree.py"
+MIRRORBASE = "/persistent-data/master/mirrors"
+TARBALLBASE = "/persistent-data/master/tarballs"
+BUILDCACHEBASE = "/persistent-data/master/buildcache"
+CASSERVERURL = "http://localhost:8011"
+CASTOKENFILE = "/config/cas-token"
+GITREFERENCEBASE = "/persistent-data/git-reference"
+CCACHEBASE = "/persistent-data/ccache"
+CCACHE_MAX_SIZE = "5G"
+CCACHE_CMAKE_ARGS = [
+    "-DCMAKE_C_COMPILER_LAUNCHER=ccache",
+    "-DCMAKE_CXX_COMPILER_LAUNCHER=ccache",
+]
+RPM_KEEP_REVISIONS = 3
+RPM_KEEP_DAYS = 7
+DEFAULT_JOBS = 4
+MEMORY_PER_JOB_MB = 1536
+DISTCC_LOG = "%(prop:builddir)s/distcc.log"
+# Lines copied to a compile step's diagnostics log, the rest are only counted.
+DIAGNOSTICS_LIMIT = 500
+WARNING_RE = re.compile(r"warning[: ]")
+ERROR_RE = re.compile(r"\berror:|^make(\[\d+\])?: \*\*\*|^CMake Error")
 
 
 def GitBaseUrl(repository):
   return "https://github.com/clementine-player/%s.git" % repository
 
 
-def GitArgs(repository):
+# What a builder needs from a repository: depth limits the history to that many
+# commits, blobless leaves out the contents of files that aren't checked out,
+# and paths limits the working copy to those directories.
+Checkout = collections.namedtuple("Checkout", ["depth", "blobless", "paths"])
+# For builders that run git describe.
+FULL_CHECKOUT = Checkout(depth=None, blobless=False, paths=())
+# For builders that need the whole tree but no history.  They can only build the
+# branch's latest revision, see Git.
+SHALLOW_CHECKOUT = Checkout(depth=1, blobless=False, paths=())
+# For builders that need the history but only the files of one revision.
+BLOBLESS_CHECKOUT = Checkout(depth=None, blobless=True, paths=())
+
+
+def SparseCheckout(*paths):
+  return Checkout(depth=1, blobless=False, paths=paths)
+
+
+def GitArgs(repository, checkout=FULL_CHECKOUT):
   return {
       "repourl": GitBaseUrl(repository),
       "branch": "master",
       "mode": "incremental",
       "retry": (5 * 60, 3),
       "workdir": "source",
+      "checkout": checkout,
   }
 
 
+def GitMirrorUrl(repository):
+  # Served by the git daemon that start.py runs on the master.  Expanded by the
+  # shell on the slave.
+  return "git://${MASTER_PORT_9989_TCP_ADDR}/%s.git" % repository
+
+
+def GitReferenceDir(repository):
+  return "%s/%s.git" % (GITREFERENCEBASE, repository)
+
+
+class MirroringGitPoller(gitpoller.GitPoller):
+  """A GitPoller that also keeps a bare mirror of the repository up to date.
+
+  The mirrors are served to the slaves so they don't all have to fetch the
+  full history from GitHub.
+  """
+
+  compare_attrs = gitpoller.GitPoller.compare_attrs + ["mirrordir"]
+
+  def __init__(self, mirrordir, **kwargs):
+    gitpoller.GitPoller.__init__(self, **kwargs)
+    self.mirrordir = mirrordir
+    # When the last poll succeeded, for the metrics.
+    self.last_poll = None
+
+  @defer.inlineCallbacks
+  def poll(self):
+    try:
+      yield gitpoller.GitPoller.poll(self)
+      self.last_poll = time.time()
+    finally:
+      yield self._UpdateMirror()
+
+  @defer.inlineCallbacks
+  def _UpdateMirror(self):
+    if os.path.exists(self.mirrordir):
+      args = ["--git-dir", self.mirrordir, "fetch", "--quiet", "--prune"]
+    else:
+      args = ["clone", "--mirror", "--quiet", self.repourl, self.mirrordir]
+
+    stdout, stderr, code = yield utils.getProcessOutputAndValue(
+        self.gitbin, args, env=os.environ)
+    if code != 0:
+      log.msg("Failed to update git mirror %s: %s" % (self.mirrordir, stderr))
+
+
 def GitPoller(repository):
-  return gitpoller.GitPoller(
+  return MirroringGitPoller(
+      mirrordir="%s/%s.git" % (MIRRORBASE, repository),
       project=repository.lower(),
       repourl=GitBaseUrl(repository),
-      pollinterval=60 * 5,  # seconds
+      # Pushes are picked up straight away through the GitHub webhook, so this
+      # only catches events that were missed.
+      pollinterval=60 * 30,  # seconds
       branch="master",
       workdir="gitpoller_%s" % repository.lower())
 
 
-class OutputFinder(shell.ShellCommand):
+def UpdateGitReference(repository):
+  reference = GitReferenceDir(repository)
+  # The reference repository is only ever added to, since clones borrow objects
+  # from it.  If the master's mirror is unreachable the checkout just fetches
+  # everything from GitHub instead.
+  command = " && ".join([
+      "if [ ! -d %(ref)s ]; then"
+      " git init --quiet --bare %(ref)s &&"
+      " git --git-dir=%(ref)s config gc.auto 0; fi",
+      "git --git-dir=%(ref)s fetch --quiet %(url)s"
+      " '+refs/heads/*:refs/heads/*' '+refs/tags/*:refs/tags/*'",
+  ]) % {"ref": reference, "url": GitMirrorUrl(repository)}
+
+  return shell.ShellCommand(
+      name="update git reference",
+      command=command,
+      workdir=".",
+      flunkOnFailure=False,
+      warnOnFailure=True)
+
+
+class Git(git.Git):
+  """A Git step that only fetches what its Checkout needs.
+
+  Shallow clones are kept shallow by fetching at the same depth and without
+  tags.  Sparse paths use core.sparseCheckout rather than git sparse-checkout,
+  which the slaves' gits are too old for, and are applied before every
+  checkout.  Blobless clones need git 2.19, older gits make normal clones.
+
+  A shallow fetch only gets the last depth commits of the branch, so a build of
+  an older revision than those fails to check it out.
+  """
+
+  BLOBLESS_GIT_VERSION = "2.19"
+
+  def __init__(self, checkout=FULL_CHECKOUT, **kwargs):
+    git.Git.__init__(self, **kwargs)
+    self.checkout = checkout
+    self.supportsBlobless = False
+
+  @defer.inlineCallbacks
+  def _dovccmd(self, command, abandonOnFailure=True, collectStdout=False,
+               initialStdin=None):
+    command = list(command)
+    sparse = bool(self.checkout.paths)
+    depth = self.checkout.depth
+    if command[:1] == ["clone"]:
+      options = []
+      if depth is not None:
+        options += ["--depth", str(depth)]
+      if self.checkout.blobless and self.supportsBlobless:
+        options.append("--filter=blob:none")
+      if sparse:
+        # Nothing is checked out until the sparse paths are set.
+        options.append("--no-checkout")
+      command[1:1] = options
+    elif command[:1] == ["fetch"] and depth is not None:
+      command = ["fetch", "--no-tags", "--depth", str(depth)] + [
+          x for x in command[1:] if x != "-t"]
+    elif command[:1] == ["reset"] and sparse:
+      yield self._SetSparsePaths()
+
+    res = yield git.Git._dovccmd(self, command, abandonOnFailure,
+                                 collectStdout, initialStdin)
+
+    if command == ["--version"]:
+      version = res.strip().split(" ")[2]
+      self.supportsBlobless = (
+          LooseVersion(version) >= LooseVersion(self.BLOBLESS_GIT_VERSION))
+      if self.checkout.blobless and not self.supportsBlobless:
+        self.stdio_log.addHeader(
+            "git %s can't make blobless clones\n" % version)
+    elif command[:1] == ["clone"] and sparse and res == 0:
+      res = yield self._dovccmd(["reset", "--hard", "HEAD", "--"],
+                                abandonOnFailure)
+    defer.returnValue(res)
+
+  @defer.inlineCallbacks
+  def _SetSparsePaths(self):
+    patterns = ["/%s/" % x.strip("/") for x in self.checkout.paths]
+    script = " && ".join([
+        "dir=$(git rev-parse --git-dir)",
+        "mkdir -p $dir/info",
+        "printf '%s\\n' \"$@\" > $dir/info/sparse-checkout",
+        "git config core.sparseCheckout true",
+    ])
+    cmd = buildstep.RemoteShellCommand(
+        self.workdir, ["sh", "-c", script, "sparse-checkout"] + patterns,
+        env=self.env, logEnviron=self.logEnviron, timeout=self.timeout)
+    cmd.useLog(self.stdio_log, False)
+    yield self.runCommand(cmd)
+    if cmd.didFail():
+      raise buildstep.BuildStepFailed()
+
+
+def _AddGitCheckout(f, repository, checkout, **kwargs):
+  git_args = GitArgs(repository, checkout)
+  # The reference repository has the whole history, so it's only worth keeping
+  # up to date for checkouts that want it.
+  if checkout.depth is None and not checkout.blobless:
+    git_args["reference"] = GitReferenceDir(repository)
+    f.addStep(UpdateGitReference(repository))
+  git_args.update(kwargs)
+
+  f.addStep(Git(**git_args))
+
+
+class FindArtifacts(buildstep.BuildStep):
+  """Finds a build's output files with the slave's glob and stat commands.
+
+  Sets the artifacts property to a list of {path, name, size, mtime} dicts, in
+  the order of the patterns and then by name.  output-filepath and
+  output-filename are set from the first one.
+  """
+
+  name = "find artifacts"
+  description = ["finding", "artifacts"]
+  flunkOnFailure = True
+  haltOnFailure = True
+  renderables = ["patterns"]
+
+  def __init__(self, patterns, workdir="source", directories=False, **kwargs):
+    buildstep.BuildStep.__init__(self, **kwargs)
+    self.patterns = patterns
+    self.workdir = workdir
+    self.directories = directories
+
+  def start(self):
+    d = self._Find()
+    d.addCallback(self.finished)
+    d.addErrback(self.failed)
+
+  @defer.inlineCallbacks
+  def _RunCommand(self, name, args, update):
+    cmd = buildstep.RemoteCommand(name, args)
+    yield self.runCommand(cmd)
+    if cmd.didFail():
+      defer.returnValue(None)
+    defer.returnValue(cmd.updates[update][-1])
+
+  @defer.inlineCallbacks
+  def _Find(self):
+    artifacts = []
+    for pattern in self.patterns:
+      files = yield self._RunCommand(
+          "glob", {"path": os.path.join(self.workdir, pattern)}, "files")
+      for path in sorted(files or []):
+        if path in [x["path"] for x in artifacts]:
+          continue
+        st = yield self._RunCommand("stat", {"file": path}, "stat")
+        if st is None:
+          continue
+        if not (stat.S_ISREG(st[stat.ST_MODE]) or
+                (self.directories and stat.S_ISDIR(st[stat.ST_MODE]))):
+          continue
+        artifacts.append({
+            "path": path,
+            "name": os.path.basename(path),
+            "size": st[stat.ST_SIZE],
+            "mtime": st[stat.ST_MTIME],
+        })
+
+    if not artifacts:
+      self.step_status.setText(["no", "artifacts"])
+      defer.returnValue(util.FAILURE)
+
+    self.setProperty("artifacts", artifacts, "FindArtifacts")
+    self.setProperty("output-filepath", artifacts[0]["path"], "FindArtifacts")
+    self.setProperty("output-filename", artifacts[0]["name"], "FindArtifacts")
+    self.addCompleteLog("artifacts", "".join(
+        "%(path)s %(size)d\n" % x for x in artifacts))
+    self.step_status.setText(["found", "%d artifacts" % len(artifacts)])
+    defer.returnValue(util.SUCCESS)
+
+
+def _AddRemoveArtifacts(f, patterns, workdir="source"):
+  # Incremental builds keep the outputs of earlier revisions around, remove
+  # them so FindArtifacts only sees this build's.
+  f.addStep(
+      shell.ShellCommand(
+          name="remove old artifacts",
+          workdir=workdir,
+          command="rm -rf " + " ".join(patterns)))
 
-  def __init__(self, pattern=None, **kwargs):
-    if pattern is None:
-      shell.ShellCommand.__init__(self, **kwargs)
-    else:
-      shell.ShellCommand.__init__(
-          self,
-          name="get output filename",
-          command=[
-              "sh", "-c",
-              "ls -dt " + pattern + " | grep -v debuginfo | head -n 1"
-          ],
-          workdir="source",
-          **kwargs)
+
+class CasUpload(shell.ShellCommand):
+  """Uploads the artifacts to the master's content addressed store.
+
+  The uploads go straight to cas_server.py on the master instead of through
+  buildbot, run in parallel, skip files the master already has and resume
+  interrupted transfers.  Each file is then published as
+  UPLOADBASE/<directory>/<name>.
+  """
+
+  def __init__(self, directory, **kwargs):
+    kwargs.setdefault("name", "upload")
+    kwargs.setdefault("description", ["uploading"])
+    kwargs.setdefault("descriptionDone", ["upload"])
+    kwargs.setdefault("haltOnFailure", True)
+
+    @util.renderer
+    def command(props):
+      return ["python", CASUPLOADSCRIPT, "--directory", directory] + [
+          x["path"] for x in props.getProperty("artifacts", [])]
+
+    shell.ShellCommand.__init__(
+        self, command=command, workdir=".", **kwargs)
+    self.directory = directory
 
   def commandComplete(self, cmd):
-    filename = self.getLog("stdio").readlines()[0].strip()
-    self.setProperty("output-filepath", filename)
-    self.setProperty("output-filename", os.path.basename(filename))
+    uploaded = {}
+    for line in self.getLog("stdio").readlines():
+      if line.startswith("uploaded: "):
+        name, sha256, sent = line.split()[1:]
+        uploaded[name] = (sha256, int(sent))
+
+    artifacts = [dict(x) for x in self.getProperty("artifacts", [])]
+    for artifact in artifacts:
+      if artifact["name"] not in uploaded:
+        continue
+      url = "%s/%s/%s" % (UPLOADURL, self.directory, artifact["name"])
+      artifact["sha256"], artifact["bytes-sent"] = uploaded[artifact["name"]]
+      artifact["url"] = url
+      artifact["directory"] = self.directory
+      self.addURL(artifact["name"], url)
+    self.setProperty("artifacts", artifacts, "CasUpload")
+
+    # Everything the build uploaded, for the build cache.
+    published = self.getProperty("published-artifacts", [])
+    self.setProperty("published-artifacts",
+                     published + [x for x in artifacts if "url" in x],
+                     "CasUpload")
+
+    self.setProperty("upload-bytes",
+                     sum(x[1] for x in uploaded.values()), "CasUpload")
+    if artifacts and "url" in artifacts[0]:
+      self.setProperty("output-sha256", artifacts[0]["sha256"], "CasUpload")
+      self.setProperty("output-url", artifacts[0]["url"], "CasUpload")
 
 
 def UploadPackage(directory):
-  return transfer.FileUpload(
-      mode=0644,
-      workdir="source",
-      slavesrc=util.Interpolate("%(prop:output-filepath)s"),
-      masterdest=util.Interpolate(
-          "%(kw:base)s/%(kw:directory)s/%(prop:output-filename)s",
-          base=UPLOADBASE,
-          directory=directory),
-      url=util.Interpolate(
-          "%(kw:base)s/%(kw:directory)s/%(prop:output-filename)s",
-          base=UPLOADURL,
-          directory=directory))
-
-
-def MakeDebBuilder(distro, version, is_64_bit):
+  return CasUpload(directory)
+
+
+def IsSuccessfulSoFar(step):
+  return step.build.result in (util.SUCCESS, util.WARNINGS)
+
+
+def _AddSnapshotSave(f, paths=None):
+  # Keeps a copy of the working copy in the master's store on slaves that set
+  # SNAPSHOT_SERVER, so they can build incrementally after losing their
+  # basedir.
+  f.addStep(
+      shell.ShellCommand(
+          name="snapshot",
+          workdir=".",
+          doStepIf=IsSuccessfulSoFar,
+          flunkOnFailure=False,
+          warnOnFailure=True,
+          command=[
+              "python", SNAPSHOTSCRIPT, "save",
+              util.Interpolate("%(prop:buildername)s"),
+          ] + (paths or [])))
+
+
+# Passed from the Source builder to the builders that use its tarball.
+TARBALL_PROPERTIES = [
+    "tarball-name",
+    "tarball-sha256",
+    "packaging-name",
+    "packaging-sha256",
+    "git-describe",
+]
+
+
+class PublishTarball(buildstep.BuildStep):
+  """Records the uploaded source and packaging tarballs for their revision.
+
+  Sets the TARBALL_PROPERTIES for the builds that are triggered next, and
+  writes them to a manifest on the master so forced builds can find them.
+  """
+
+  name = "publish tarball"
+  description = ["publishing", "tarball"]
+  flunkOnFailure = True
+  haltOnFailure = True
+
+  def start(self):
+    # In the order FindArtifacts was given the patterns.
+    tarball, packaging = self.getProperty("artifacts")[:2]
+    revision = self.getProperty("got_revision")
+    manifest = {
+        "revision": revision,
+        "url": tarball["url"],
+        "tarball-name": tarball["name"],
+        "tarball-sha256": tarball["sha256"],
+        "packaging-name": packaging["name"],
+        "packaging-sha256": packaging["sha256"],
+        "git-describe": self.getProperty("git-describe"),
+    }
+    for key in TARBALL_PROPERTIES:
+      self.setProperty(key, manifest[key], "PublishTarball")
+
+    if not os.path.exists(TARBALLBASE):
+      os.makedirs(TARBALLBASE)
+    for filename in (revision + ".json", "latest.json"):
+      path = os.path.join(TARBALLBASE, filename)
+      with open(path + ".tmp", "w") as fh:
+        json.dump(manifest, fh)
+      os.rename(path + ".tmp", path)
+
+    self.addCompleteLog("manifest", json.dumps(manifest, indent=2))
+    self.step_status.setText(["published", "tarball"])
+    self.finished(util.SUCCESS)
+
+
+class LookupTarball(buildstep.BuildStep):
+  """Sets the TARBALL_PROPERTIES of the source tarball to build from.
+
+  Triggered builds get them from the Source build that made the tarball.
+  Otherwise the tarball published for the build's revision is used, or the
+  latest one if the build isn't for a particular revision.
+  """
+
+  name = "lookup tarball"
+  description = ["looking", "up", "tarball"]
+  flunkOnFailure = True
+  haltOnFailure = True
+
+  def start(self):
+    revision = self.build.getSourceStamp().revision
+    if self.getProperty("tarball-sha256"):
+      self.setProperty("got_revision", revision, "LookupTarball")
+      self.step_status.setText(["tarball", "from", "trigger"])
+      return self.finished(util.SUCCESS)
+
+    path = os.path.join(TARBALLBASE, (revision or "latest") + ".json")
+    manifest = {}
+    if os.path.exists(path):
+      with open(path) as fh:
+        manifest = json.load(fh)
+    if not all(manifest.get(key) for key in TARBALL_PROPERTIES):
+      self.addCompleteLog(
+          "error", "No tarball was published for %s, build the Source "
+          "builder first.\n" % (revision or "any revision"))
+      self.step_status.setText(["no", "tarball"])
+      return self.finished(util.FAILURE)
+
+    self.setProperty("got_revision", manifest["revision"], "LookupTarball")
+    for key in TARBALL_PROPERTIES:
+      self.setProperty(key, manifest[key], "LookupTarball")
+    self.step_status.setText(["tarball", manifest["revision"][:12]])
+    self.finished(util.SUCCESS)
+
+
+def TriggerTarballBuilders(schedulers):
+  return trigger.Trigger(
+      schedulerNames=schedulers,
+      updateSourceStamp=True,
+      copy_properties=TARBALL_PROPERTIES)
+
+
+def _AddFetchTarball(f, directory, kind="tarball"):
+  # The download is checked against the tarball's sha256, and skipped if the
+  # slave already has it.
+  f.addStep(
+      shell.ShellCommand(
+          name="fetch " + kind,
+          workdir=".",
+          haltOnFailure=True,
+          command=[
+              "python", CASFETCHSCRIPT,
+              "--sha256", util.Property(kind + "-sha256"),
+              util.Interpolate(
+                  "%s/%%(prop:%s-name)s" % (directory, kind)),
+          ]))
+
+
+def _LocalJobs(props):
+  jobs = props.getProperty("jobs")
+  if jobs is None:
+    cpus = props.getProperty("slave-cpus")
+    memory = props.getProperty("slave-memory-mb")
+    if cpus is None:
+      jobs = DEFAULT_JOBS
+    elif memory is None:
+      jobs = cpus
+    else:
+      jobs = min(cpus, memory // MEMORY_PER_JOB_MB)
+
+    share = props.getProperty("cpu-share")
+    if share is not None:
+      jobs = min(jobs, share)
+  return max(1, int(jobs))
+
+
+def Jobs(fmt="%d"):
+  """Renders the number of parallel compile jobs for the build's slave.
+
+  A "jobs" property set on the builder wins, otherwise it's derived from the
+  CPUs and memory the slave reported when it connected, and limited to the
+  builder's share of the host's CPUs.  The jobs that distcc sends to other
+  slaves are on top of those.
+  """
+
+  @util.renderer
+  def render(props):
+    return fmt % (_LocalJobs(props) + props.getProperty("distcc-slots", 0))
+
+  return render
+
+
+def CcacheEnv(namespace, env=None):
+  env = dict(env or {})
+  env["CCACHE_DIR"] = "%s/%s" % (CCACHEBASE, namespace)
+  # Hash paths relative to the shared volume so builders with different
+  # builddirs can reuse each other's objects.
+  env["CCACHE_BASEDIR"] = "/persistent-data"
+  env["PATH"] = ":".join([
+      "/usr/lib/ccache",
+      "/usr/lib64/ccache",
+      env.get("PATH", "${PATH}"),
+  ])
+  return env
+
+
+# ccache's counters are cumulative, so a baseline is recorded before the
+# compile and the properties are set from the difference afterwards.  That's
+# only this build's if no other builder uses the same cache at the same time,
+# so every builder has a namespace of its own.  ccache 4.4 and later have
+# --print-stats; older versions only have the --show-stats table.
+class CcacheStats(shell.ShellCommand):
+
+  STATS_RE = re.compile(
+      r"^(cache hit \((?:direct|preprocessed)\)|cache miss|"
+      r"(?:direct|preprocessed)_cache_hit|cache_miss)\s+(\d+)\s*$")
+
+  def __init__(self, baseline=False, **kwargs):
+    kwargs.setdefault("name", "ccache baseline" if baseline else "ccache stats")
+    kwargs.setdefault(
+        "command", "ccache --print-stats 2>/dev/null || ccache --show-stats")
+    kwargs.setdefault("flunkOnFailure", False)
+    kwargs.setdefault("warnOnFailure", True)
+    shell.ShellCommand.__init__(self, **kwargs)
+    self.baseline = baseline
+
+  def commandComplete(self, cmd):
+    if cmd.didFail():
+      return
+
+    counters = {"hits": 0, "misses": 0}
+    for line in self.getLog("stdio").readlines():
+      match = self.STATS_RE.match(line)
+      if match is None:
+        continue
+      key = "misses" if "miss" in match.group(1) else "hits"
+      counters[key] += int(match.group(2))
+
+    if self.baseline:
+      self.setProperty("ccache-baseline", counters)
+      return
+
+    baseline = self.getProperty("ccache-baseline", {})
+    hits = counters["hits"] - baseline.get("hits", 0)
+    misses = counters["misses"] - baseline.get("misses", 0)
+    self.setProperty("ccache-hits", hits)
+    self.setProperty("ccache-misses", misses)
+    if hits + misses:
+      self.setProperty("ccache-hit-rate",
+                       round(100.0 * hits / (hits + misses), 1))
+
+
+def _AddCcacheSetup(f, env):
+  f.addStep(
+      shell.ShellCommand(
+          name="ccache setup",
+          env=env,
+          flunkOnFailure=False,
+          warnOnFailure=True,
+          command=["ccache", "--max-size=" + CCACHE_MAX_SIZE]))
+  f.addStep(CcacheStats(baseline=True, env=env))
+
+
+def _AddCcacheStats(f, env):
+  f.addStep(CcacheStats(env=env))
+
+
+def _Describe(value):
+  """Turns a step's arguments into something that can be hashed.
+
+  Renderables are described by their class and compare_attrs, functions by
+  their name.
+  """
+  if isinstance(value, dict):
+    return dict((str(k), _Describe(v)) for k, v in value.iteritems())
+  if isinstance(value, (list, tuple)):
+    return [_Describe(x) for x in value]
+  if value is None or isinstance(value, (basestring, int, long, float, bool)):
+    return value
+  if isinstance(value, type):
+    return value.__name__
+  if hasattr(value, "compare_attrs"):
+    return [type(value).__name__] + [
+        _Describe(getattr(value, x, None)) for x in value.compare_attrs]
+  if hasattr(value, "getRenderingFor"):
+    value = value.getRenderingFor
+  return getattr(value, "__name__", type(value).__name__)
+
+
+def BuildKey(build):
+  """Hashes everything that goes into a build's artifacts: the builder's steps
+  with their commands, environments and cmake flags, and the source."""
+  inputs = {
+      "builder": build.builder.name,
+      "steps": _Describe(build.builder.config.factory.steps),
+      "revision": build.getProperty("got_revision"),
+      "tarball": build.getProperty("tarball-sha256"),
+  }
+  return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+def IsCacheBypassed(step):
+  return IsCleanBuild(step) or bool(step.build.getProperty("nocache"))
+
+
+def IsCacheHit(step):
+  return bool(step.build.getProperty("build-cache-hit"))
+
+
+class CheckBuildCache(buildstep.BuildStep):
+  """Looks for an earlier build with the same build key.
+
+  On a hit the build-cache-hit property is set to the earlier build's number.
+  """
+
+  name = "check build cache"
+  description = ["checking", "build", "cache"]
+  flunkOnFailure = True
+  haltOnFailure = True
+
+  def start(self):
+    key = BuildKey(self.build)
+    self.setProperty("build-key", key, "CheckBuildCache")
+    path = os.path.join(BUILDCACHEBASE, key + ".json")
+
+    if IsCacheBypassed(self):
+      self.step_status.setText(["build", "cache", "bypassed"])
+    elif not os.path.exists(path):
+      self.step_status.setText(["build", "cache", "miss"])
+    else:
+      with open(path) as fh:
+        entry = json.load(fh)
+      self.setProperty("build-cache-hit", entry["buildnumber"],
+                       "CheckBuildCache")
+      self.setProperty("cached-artifacts", entry["artifacts"],
+                       "CheckBuildCache")
+      self.addCompleteLog("entry", json.dumps(entry, indent=2))
+      self.step_status.setText(
+          ["build", "cache", "hit", "#%d" % entry["buildnumber"]])
+    self.finished(util.SUCCESS)
+
+
+class RepublishArtifacts(buildstep.BuildStep):
+  """Publishes the artifacts of the cached build again.
+
+  The files are still in cas_server.py's store, so they're just linked into
+  their directories again.  Sets the same properties as CasUpload.
+  """
+
+  name = "republish"
+  description = ["republishing"]
+  flunkOnFailure = True
+  haltOnFailure = True
+
+  def start(self):
+    d = self._Republish()
+    d.addCallback(self.finished)
+    d.addErrback(self.failed)
+
+  @defer.inlineCallbacks
+  def _Republish(self):
+    artifacts = self.getProperty("cached-artifacts")
+    with open(CASTOKENFILE) as fh:
+      headers = {"Authorization": "Bearer " + fh.read().strip()}
+    for artifact in artifacts:
+      try:
+        yield client.getPage(
+            str("%s/links/%s/%s" % (
+                CASSERVERURL, artifact["directory"], artifact["name"])),
+            method="POST", postdata=str(artifact["sha256"]), headers=headers)
+      except Exception as ex:
+        self.addCompleteLog("error", "Republishing %s failed: %s\nForce a "
+                            "build without the build cache.\n" % (
+                                artifact["name"], ex))
+        self.step_status.setText(["republish", "failed"])
+        defer.returnValue(util.FAILURE)
+      self.addURL(artifact["name"], artifact["url"])
+
+    self.setProperty("artifacts", artifacts, "RepublishArtifacts")
+    self.setProperty("published-artifacts", artifacts, "RepublishArtifacts")
+    self.setProperty("upload-bytes", 0, "RepublishArtifacts")
+    self.setProperty("output-filename", artifacts[0]["name"],
+                     "RepublishArtifacts")
+    self.setProperty("output-sha256", artifacts[0]["sha256"],
+                     "RepublishArtifacts")
+    self.setProperty("output-url", artifacts[0]["url"], "RepublishArtifacts")
+    self.step_status.setText(["republished", "%d artifacts" % len(artifacts)])
+    defer.returnValue(util.SUCCESS)
+
+
+class StoreBuildCache(buildstep.BuildStep):
+  """Remembers the build's artifacts under its build key."""
+
+  name = "store build cache"
+  description = ["storing", "build", "cache"]
+
+  def start(self):
+    entry = {
+        "builder": self.build.builder.name,
+        "buildnumber": self.build.build_status.getNumber(),
+        "revision": self.getProperty("got_revision"),
+        "artifacts": self.getProperty("published-artifacts", []),
+    }
+    if not entry["artifacts"]:
+      self.step_status.setText(["nothing", "to", "cache"])
+      return self.finished(util.SUCCESS)
+
+    if not os.path.exists(BUILDCACHEBASE):
+      os.makedirs(BUILDCACHEBASE)
+    path = os.path.join(BUILDCACHEBASE, self.getProperty("build-key") + ".json")
+    with open(path + ".tmp", "w") as fh:
+      json.dump(entry, fh)
+    os.rename(path + ".tmp", path)
+    self.step_status.setText(["stored", "build", "cache"])
+    self.finished(util.SUCCESS)
+
+
+def _OnCacheMiss(do_step_if):
+  def DoStepIf(step):
+    if IsCacheHit(step):
+      return False
+    return do_step_if(step) if callable(do_step_if) else do_step_if
+  return DoStepIf
+
+
+def _AddBuildCache(f, keep=()):
+  """Lets a build republish the artifacts of an earlier build with the same
+  BuildKey instead of building them again.
+
+  Call it once the factory is complete.  On a hit every step after the
+  checkout is skipped, except the ones named in keep.
+  """
+  # The key needs the revision, which is known after the checkout.
+  index = 1 + max(i for i, step in enumerate(f.steps)
+                  if issubclass(step.factory, (git.Git, LookupTarball)))
+  for step in f.steps[index:]:
+    name = step.kwargs.get("name", getattr(step.factory, "name", None))
+    if name not in keep:
+      step.kwargs["doStepIf"] = _OnCacheMiss(step.kwargs.get("doStepIf", True))
+
+  f.steps[index:index] = [
+      interfaces.IBuildStepFactory(CheckBuildCache()),
+      interfaces.IBuildStepFactory(RepublishArtifacts(doStepIf=IsCacheHit)),
+  ]
+  f.addStep(
+      StoreBuildCache(
+          doStepIf=lambda step: not IsCacheHit(step) and IsSuccessfulSoFar(step)))
+
+
+class DiagnosticsObserver(buildstep.LogLineObserver):
+  """Copies warnings and errors to the step's diagnostics log as they're
+  printed, with the number of the output line they were on."""
+
+  def __init__(self):
+    buildstep.LogLineObserver.__init__(self)
+    self.lines = 0
+    self.counts = {"warning": 0, "error": 0}
+
+  def _LineReceived(self, line, add):
+    self.lines += 1
+    if ERROR_RE.search(line):
+      kind = "error"
+    elif WARNING_RE.search(line):
+      kind = "warning"
+    else:
+      return
+
+    self.counts[kind] += 1
+    copied = sum(self.counts.values())
+    if copied <= DIAGNOSTICS_LIMIT:
+      add("%7d  %s\n" % (self.lines, line))
+    elif copied == DIAGNOSTICS_LIMIT + 1:
+      self.step.diagnostics.addHeader("Only counting the rest, see stdio.\n")
+
+  def outLineReceived(self, line):
+    self._LineReceived(line, self.step.diagnostics.addStdout)
+
+  def errLineReceived(self, line):
+    self._LineReceived(line, self.step.diagnostics.addStderr)
+
+
+class Compile(shell.Compile):
+  """A Compile step that collects the warnings and errors while it runs.
+
+  They go to a diagnostics log, which comes before stdio so the web status
+  shows it first.  Unlike shell.Compile, the whole of stdio isn't read back
+  into memory to count the warnings afterwards.
+  """
+
+  def __init__(self, **kwargs):
+    shell.Compile.__init__(self, **kwargs)
+    self.diagnostics_observer = DiagnosticsObserver()
+    self.addLogObserver("stdio", self.diagnostics_observer)
+
+  def start(self):
+    self.diagnostics = self.addLog("diagnostics")
+    return shell.Compile.start(self)
+
+  def createSummary(self, log):
+    counts = self.diagnostics_observer.counts
+    self.diagnostics.addHeader("%d errors, %d warnings\n" % (
+        counts["error"], counts["warning"]))
+    self.diagnostics.finish()
+
+    self.warnCount = counts["warning"]
+    for kind in ("warning", "error"):
+      name = "%ss-count" % kind
+      self.setProperty(name, self.getProperty(name, 0) + counts[kind],
+                       "Compile")
+
+
+class ProfileMixin(object):
+  """Runs a ShellCommand's command under profile.py on the slave.
+
+  What the command's process tree used is attached as the step's profile log,
+  and added to the build's profile property under the step's name.
+  """
+
+  def start(self):
+    self.profile_path = "/tmp/buildbot-profile-%s-%s-%s.txt" % tuple(
+        re.sub(r"[^A-Za-z0-9_.-]", "-", str(x)) for x in (
+            self.getProperty("buildername"), self.getProperty("buildnumber"),
+            self.name))
+    self.logfiles = dict(self.logfiles, profile=self.profile_path)
+    return super(ProfileMixin, self).start()
+
+  def buildCommandKwargs(self, *args):
+    kwargs = super(ProfileMixin, self).buildCommandKwargs(*args)
+    command = kwargs["command"]
+    if isinstance(command, basestring):
+      command = ["/bin/sh", "-c", command]
+    kwargs["command"] = [
+        "python", PROFILESCRIPT, "--output", self.profile_path, "--"] + command
+    return kwargs
+
+  def commandComplete(self, cmd):
+    super(ProfileMixin, self).commandComplete(cmd)
+    if "profile" not in cmd.logs:
+      return
+
+    profile = {}
+    for line in cmd.logs["profile"].getText().splitlines():
+      try:
+        name, value = line.split()
+        profile[name] = float(value)
+      except ValueError:
+        continue
+    if profile:
+      profiles = dict(self.getProperty("profile", {}))
+      profiles[self.name] = profile
+      self.setProperty("profile", profiles, "ProfileMixin")
+
+
+_PROFILED_CLASSES = {}
+
+
+def ProfileSteps(f):
+  """Runs every shell step of the factory under profile.py."""
+  for step in f.steps:
+    if not issubclass(step.factory, shell.ShellCommand):
+      continue
+    if step.factory not in _PROFILED_CLASSES:
+      _PROFILED_CLASSES[step.factory] = type(
+          "Profiled" + step.factory.__name__, (ProfileMixin, step.factory), {})
+    step.factory = _PROFILED_CLASSES[step.factory]
+
+
+def DistccEnv(env):
+  """Sends ccache's misses to distcc, if FindDistccPeers found any peers."""
+  env = dict(env)
+  env["CCACHE_PREFIX"] = util.Interpolate("%(prop:distcc-prefix:-)s")
+  env["DISTCC_HOSTS"] = util.Interpolate("%(prop:distcc-hosts:-)s")
+  # Read by DistccStats to count the jobs each host ran.
+  env["DISTCC_LOG"] = util.Interpolate(DISTCC_LOG)
+  env["DISTCC_VERBOSE"] = "1"
+  return env
+
+
+class FindDistccPeers(buildstep.BuildStep):
+  """Picks the idle slaves with the same toolchain as this build's slave.
+
+  Sets distcc-hosts for DISTCC_HOSTS, with the peers first and this slave last,
+  and distcc-slots to the number of jobs the peers take, which Jobs adds to the
+  local ones.
+  """
+
+  name = "find distcc peers"
+  description = ["finding", "distcc", "peers"]
+
+  def start(self):
+    own = self.build.slavebuilder.slave
+    toolchain = getattr(own, "host_properties", {}).get("slave-toolchain")
+
+    peers = []
+    for slave in self.build.builder.botmaster.slaves.itervalues():
+      host = getattr(slave, "host_properties", {})
+      if (slave is own or toolchain is None or slave.slave is None or
+          host.get("slave-toolchain") != toolchain or
+          "slave-distcc" not in host):
+        continue
+      if any(x.isBusy() for x in slave.slavebuilders.itervalues()):
+        continue
+      peers.append((slave.slavename, host["slave-distcc"],
+                    host.get("slave-cpus", DEFAULT_JOBS)))
+
+    slots = sum(cpus for _, _, cpus in peers)
+    self.setProperty("distcc-slots", slots, "FindDistccPeers")
+    if not peers:
+      self.setProperty("distcc-prefix", "", "FindDistccPeers")
+      self.step_status.setText(["no", "distcc", "peers"])
+      self.finished(util.SUCCESS)
+      return
+
+    hosts = ["%s/%d,lzo" % (address, cpus) for _, address, cpus in peers]
+    hosts.append("localhost/%d" % _LocalJobs(self.build))
+    self.setProperty("distcc-prefix", "distcc", "FindDistccPeers")
+    self.setProperty("distcc-hosts", " ".join(hosts), "FindDistccPeers")
+    self.addCompleteLog("peers", "".join(
+        "%s %s/%d\n" % peer for peer in peers))
+    self.step_status.setText(
+        ["%d" % len(peers), "distcc", "peers", "%d jobs" % slots])
+    self.finished(util.SUCCESS)
+
+
+class DistccStats(shell.ShellCommand):
+  """Counts the compile jobs distcc ran on each host during the compile.
+
+  Sets distcc-remote and distcc-local, and distcc-remote-percent when distcc
+  ran anything.
+  """
+
+  # distcc logs its own host as localhost/<jobs>.
+  STATS_RE = re.compile(r"^\s*(\d+) exec on ([^/\s]+)")
+
+  def __init__(self, **kwargs):
+    kwargs.setdefault("name", "distcc stats")
+    kwargs.setdefault("description", ["counting", "distcc", "jobs"])
+    kwargs.setdefault("descriptionDone", ["distcc", "stats"])
+    kwargs.setdefault("command", util.Interpolate(
+        "if [ -f %(log)s ]; then grep -o 'exec on [^:]*' %(log)s"
+        " | sort | uniq -c; rm -f %(log)s; fi" % {"log": DISTCC_LOG}))
+    kwargs.setdefault("flunkOnFailure", False)
+    kwargs.setdefault("warnOnFailure", True)
+    kwargs.setdefault("alwaysRun", True)
+    shell.ShellCommand.__init__(self, **kwargs)
+
+  def commandComplete(self, cmd):
+    if cmd.didFail():
+      return
+
+    counts = {"remote": 0, "local": 0}
+    for line in self.getLog("stdio").readlines():
+      match = self.STATS_RE.match(line)
+      if match is None:
+        continue
+      where = "local" if match.group(2) == "localhost" else "remote"
+      counts[where] += int(match.group(1))
+
+    for where, count in counts.iteritems():
+      self.setProperty("distcc-" + where, count, "DistccStats")
+    total = counts["remote"] + counts["local"]
+    if total:
+      self.setProperty("distcc-remote-percent",
+                       round(100.0 * counts["remote"] / total, 1),
+                       "DistccStats")
+
+
+def DistributeCompiles(f):
+  """Lets the Compile steps of the factory that use ccache send compile jobs
+  to idle slaves with the same toolchain through distcc."""
+  for i in reversed(range(len(f.steps))):
+    step = f.steps[i]
+    env = step.kwargs.get("env") or {}
+    if not issubclass(step.factory, Compile) or "CCACHE_DIR" not in env:
+      continue
+
+    step.kwargs["env"] = DistccEnv(env)
+    do_step_if = step.kwargs.get("doStepIf", True)
+    f.steps[i:i + 1] = [
+        interfaces.IBuildStepFactory(FindDistccPeers(doStepIf=do_step_if)),
+        step,
+        interfaces.IBuildStepFactory(
+            DistccStats(workdir=".", doStepIf=do_step_if)),
+    ]
+
+
+def MakeDebBuilder(distro, version, is_64_bit, use_ccache=True):
   arch = "amd64" if is_64_bit else "i386"
 
-  env = {"DEB_BUILD_OPTIONS": "parallel=4",}
+  env = {"DEB_BUILD_OPTIONS": Jobs("parallel=%d"),}
+  if use_ccache:
+    env = CcacheEnv(
+        "%s-%s-%s" % (distro, version, "64" if is_64_bit else "32"), env)
 
   cmake_cmd = [
       "cmake",
@@ -89,66 +1069,76 @@ def MakeDebBuilder(distro, version, is_64_bit):
   ]
   make_cmd = ["make", "deb"]
 
+  artifacts = ["bin/clementine_*.deb"]
+
   f = factory.BuildFactory()
-  f.addStep(git.Git(**GitArgs("Clementine")))
+  _AddGitCheckout(f, "Clementine", FULL_CHECKOUT)
+  _AddRemoveArtifacts(f, artifacts)
   f.addStep(
       shell.ShellCommand(
           name="cmake",
           command=cmake_cmd,
           haltOnFailure=True,
           workdir="source/bin"))
+  if use_ccache:
+    _AddCcacheSetup(f, env)
   f.addStep(
-      shell.Compile(
+      Compile(
           command=make_cmd, haltOnFailure=True, workdir="source/bin", env=env))
-  f.addStep(OutputFinder(pattern="bin/clementine_*.deb"))
+  if use_ccache:
+    _AddCcacheStats(f, env)
+  f.addStep(FindArtifacts(artifacts))
   f.addStep(UploadPackage("%s-%s" % (distro, version)))
+  _AddSnapshotSave(f)
+  _AddBuildCache(f)
   return f
 
 
 def MakePPABuilder(distro, ppa):
-  git_args = GitArgs("Clementine")
-  git_args["mode"] = "full"
-
+  # The source package is made from the Source builder's tarball, with the
+  # debian directory from its packaging tarball configured for this distro.
   cmake_cmd = [
       "cmake",
       "..",
       "-DWITH_DEBIAN=ON",
       "-DDEB_DIST=" + distro,
+      util.Interpolate("-DFORCE_GIT_REVISION=%(prop:git-describe)s"),
   ]
-  clean_cmd = "rm -rvf *.diff.*z *.tar.*z *.dsc *_source.changes source/bin/*"
+  clean_cmd = "rm -rvf *.diff.*z *.tar.*z *.dsc *_source.changes source"
+  unpack_cmd = util.Interpolate(
+      "mkdir source && "
+      "tar -xJf %(prop:tarball-name)s -C source --strip-components=1 && "
+      "tar -xJf %(prop:packaging-name)s -C source")
+  # dpkg-source wants the tarball named after the upstream version in the
+  # changelog that cmake just wrote.
+  origtarball_cmd = util.Interpolate(
+      "version=$(cd source && dpkg-parsechangelog -SVersion"
+      " | sed -e 's/^[0-9]*://' -e 's/-[^-]*$//') && "
+      "cp -v %(prop:tarball-name)s clementine_${version}.orig.tar.xz")
   buildpackage_cmd = ["dpkg-buildpackage", "-S", "-kF6ABD82E"]
-  movetarball_cmd = "mv -v source/dist/*.orig.tar.xz ."
-  cleanuptarball_cmd = "rm -rfv source/dist/*.tar.*z source/.git"
   keys_cmd = "gpg --import /config/ppa-keys || true"
   dput_cmd = "dput %s *_source.changes" % ppa
 
   f = factory.BuildFactory()
-  f.addStep(git.Git(**git_args))
-  f.addStep(
-      shell.ShellCommand(
-          name="cmake",
-          command=cmake_cmd,
-          haltOnFailure=True,
-          workdir="source/bin"))
+  f.addStep(LookupTarball())
   f.addStep(
       shell.ShellCommand(
           name="clean", command=clean_cmd, haltOnFailure=True, workdir="."))
+  _AddFetchTarball(f, ".")
+  _AddFetchTarball(f, ".", "packaging")
   f.addStep(
       shell.ShellCommand(
-          name="maketarball",
-          command=["./maketarball.sh"],
-          haltOnFailure=True,
-          workdir="source/dist"))
+          name="unpack", command=unpack_cmd, haltOnFailure=True, workdir="."))
   f.addStep(
       shell.ShellCommand(
-          name="movetarball",
-          command=movetarball_cmd,
+          name="cmake",
+          command=cmake_cmd,
           haltOnFailure=True,
-          workdir="."))
+          workdir="source/bin"))
   f.addStep(
       shell.ShellCommand(
-          name="cleanuptarball",
-          command=cleanuptarball_cmd,
+          name="origtarball",
+          command=origtarball_cmd,
           haltOnFailure=True,
           workdir="."))
   f.addStep(shell.ShellCommand(name="keys", command=keys_cmd, workdir="."))
@@ -166,7 +1156,7 @@ def MakePPABuilder(distro, ppa):
 
 def MakeWindowsDepsBuilder():
   f = factory.BuildFactory()
-  f.addStep(git.Git(**GitArgs("Dependencies")))
+  _AddGitCheckout(f, "Dependencies", SHALLOW_CHECKOUT)
   f.addStep(
       shell.ShellCommand(
           name="clean", workdir="source/windows", command=["make", "clean"]))
@@ -176,7 +1166,7 @@ def MakeWindowsDepsBuilder():
   return f
 
 
-def MakeWindowsBuilder(is_debug, is_portable):
+def MakeWindowsBuilder(is_debug, use_ccache=True):
   env = {
       "PKG_CONFIG_LIBDIR": "/target/lib/pkgconfig",
       "PATH": ":".join([
@@ -198,6 +1188,10 @@ def MakeWindowsBuilder(is_debug, is_portable):
       "-DPROTOBUF_PROTOC_EXECUTABLE=/usr/bin/protoc",
   ]
 
+  if use_ccache:
+    env = CcacheEnv("mingw-debug" if is_debug else "mingw-release", env)
+    cmake_cmd += CCACHE_CMAKE_ARGS
+
   executable_files = [
       "clementine.exe",
       "clementine-tagreader.exe",
@@ -206,17 +1200,22 @@ def MakeWindowsBuilder(is_debug, is_portable):
 
   strip_command = "i686-w64-mingw32-strip"
 
-  if is_portable:
-    nsi_filename = "clementine-portable.nsi"
-    output_glob = "Clementine-PortableSetup*.exe"
-    upload_dest = "portable"
+  # The installers that are made from the same compiled binaries, as
+  # (nsi filename, output glob, upload directory).
+  if is_debug:
+    packages = [
+        ("clementine.nsi", "ClementineSetup*.exe", "debug"),
+    ]
   else:
-    nsi_filename = "clementine.nsi"
-    output_glob = "ClementineSetup*.exe"
-    upload_dest = ("debug" if is_debug else "release")
+    packages = [
+        ("clementine.nsi", "ClementineSetup*.exe", "release"),
+        ("clementine-portable.nsi", "Clementine-PortableSetup*.exe",
+         "portable"),
+    ]
 
   f = factory.BuildFactory()
-  f.addStep(git.Git(**GitArgs("Clementine")))
+  _AddGitCheckout(f, "Clementine", FULL_CHECKOUT)
+  _AddRemoveArtifacts(f, ["dist/windows/" + x[1] for x in packages])
   f.addStep(
       shell.ShellCommand(
           name="cmake",
@@ -237,9 +1236,16 @@ def MakeWindowsBuilder(is_debug, is_portable):
           haltOnFailure=True,
           command=["ln", "-svf"] + ["../../bin/" + x for x in executable_files]
           + ["."]))
+  if use_ccache:
+    _AddCcacheSetup(f, env)
   f.addStep(
-      shell.Compile(
-          command=["make", "-j4"], workdir="source/bin", haltOnFailure=True))
+      Compile(
+          command=["make", Jobs("-j%d")],
+          workdir="source/bin",
+          env=env,
+          haltOnFailure=True))
+  if use_ccache:
+    _AddCcacheStats(f, env)
   f.addStep(
       shell.ShellCommand(
           name="strip",
@@ -247,74 +1253,173 @@ def MakeWindowsBuilder(is_debug, is_portable):
           haltOnFailure=True,
           env=env,
           command=[strip_command] + executable_files))
-  f.addStep(
-      shell.ShellCommand(
-          name="makensis",
-          command=["makensis", nsi_filename],
-          workdir="source/dist/windows",
-          haltOnFailure=True))
-  f.addStep(OutputFinder(pattern="dist/windows/" + output_glob))
-  f.addStep(UploadPackage("win32/" + upload_dest))
+  for nsi_filename, output_glob, upload_dest in packages:
+    f.addStep(
+        shell.ShellCommand(
+            name="makensis " + upload_dest,
+            command=["makensis", nsi_filename],
+            workdir="source/dist/windows",
+            haltOnFailure=True))
+    f.addStep(FindArtifacts(["dist/windows/" + output_glob]))
+    f.addStep(UploadPackage("win32/" + upload_dest))
+  _AddSnapshotSave(f)
+  _AddBuildCache(f)
   return f
 
 
-def MakeFedoraBuilder(distro, is_64_bit):
+def IsCleanBuild(step):
+  return bool(step.build.getProperty("clean"))
+
+
+def MakeFedoraBuilder(distro, is_64_bit, use_ccache=True):
+  env = {}
+  if use_ccache:
+    env = CcacheEnv("fedora-%s-%s" % (distro, "64" if is_64_bit else "32"))
+
+  # rpmbuild works in a tree that's kept between builds.  Every revision's
+  # sources are copied over the same BUILD/tree, which keeps its bin directory,
+  # so the compile only rebuilds what changed since the last build.  The
+  # tarball is made once for every distro and architecture by the Source
+  # builder.
+  topdir = "%(prop:builddir)s/rpmbuild"
+  spec = "rpmbuild/SPECS/clementine.spec"
+  target = [] if is_64_bit else ["--target=i686-fedora-linux"]
+  # The "rpmbuild prep" step below does the unpacking.  --noprep would skip
+  # %prep in the compile, but needs rpm 4.15 and the slaves have 4.13 and 4.14,
+  # so the %prep script is run with /bin/true instead.
+  noprep = ["--define", "__spec_prep_cmd /bin/true"]
+  rpmbuild_cmd = [
+      "rpmbuild",
+      "--define", util.Interpolate("_topdir " + topdir),
+      "--define", util.Interpolate("_builddir " + topdir + "/BUILD"),
+      "--define", Jobs("_smp_mflags -j%d"),
+  ] + target
+
   f = factory.BuildFactory()
-  f.addStep(git.Git(**GitArgs("Clementine")))
+  f.addStep(LookupTarball())
   f.addStep(
       shell.ShellCommand(
           name="clean",
-          workdir="source/bin",
-          command="find ~/rpmbuild/ -type f -delete"))
+          workdir=".",
+          doStepIf=IsCleanBuild,
+          hideStepIf=lambda results, step: not IsCleanBuild(step),
+          command=["rm", "-rf", "rpmbuild"]))
   f.addStep(
       shell.ShellCommand(
-          name="cmake",
-          workdir="source/bin",
-          haltOnFailure=True,
-          command=["cmake", ".."]))
+          name="prune",
+          workdir=".",
+          flunkOnFailure=False,
+          warnOnFailure=True,
+          command=" && ".join([
+              "mkdir -p rpmbuild/BUILD rpmbuild/SOURCES rpmbuild/SPECS",
+              # Keep the newest few revisions' tarballs and packaging
+              # tarballs...
+              "ls -dt rpmbuild/SOURCES/* rpmbuild/SPECS/*.tar.* 2>/dev/null"
+              " | awk -F/ '{ if (++seen[$2] > %d) print }'"
+              " | xargs -r rm -rf" % RPM_KEEP_REVISIONS,
+              # ...and buildroots from the last week.
+              "find rpmbuild/BUILDROOT -mindepth 1 -maxdepth 1"
+              " -mtime +%d -print0 2>/dev/null"
+              " | xargs -0 -r rm -rf" % RPM_KEEP_DAYS,
+              # The packages have been uploaded, only this build's are kept.
+              "rm -rf rpmbuild/RPMS rpmbuild/SRPMS",
+              # Left over from when every builder cloned the repository, and
+              # from when each revision had its own BUILD tree.
+              "rm -rf source",
+              "find rpmbuild/BUILD -mindepth 1 -maxdepth 1 ! -name tree"
+              " -exec rm -rf {} +",
+          ])))
+  _AddFetchTarball(f, "rpmbuild/SOURCES")
+  _AddFetchTarball(f, "rpmbuild/SPECS", "packaging")
   f.addStep(
       shell.ShellCommand(
-          name="maketarball",
-          workdir="source/bin",
+          name="extract spec",
+          workdir=".",
           haltOnFailure=True,
-          command=["../dist/maketarball.sh"]))
+          command=util.Interpolate(
+              "tar -xJOf rpmbuild/SPECS/%%(prop:packaging-name)s "
+              "dist/clementine.spec > %s" % spec)))
   f.addStep(
       shell.ShellCommand(
-          name="movetarball",
-          workdir="source/bin",
+          name="rpmbuild prep",
+          workdir=".",
           haltOnFailure=True,
-          command="mv clementine-*.tar.xz ~/rpmbuild/SOURCES"))
+          # Unpacks the revision into BUILD/unpack, copies what changed into
+          # BUILD/tree, and links the directory the spec expects to the tree.
+          command=util.Interpolate(" && ".join([
+              "rm -rf rpmbuild/BUILD/unpack rpmbuild/BUILD/clementine-*",
+              "mkdir -p rpmbuild/BUILD/unpack rpmbuild/BUILD/tree",
+              "rpmbuild --define '_topdir %(topdir)s' "
+              "--define '_builddir %(topdir)s/BUILD/unpack' %(target)s "
+              "-bp --nodeps %(spec)s",
+              "dir=$(cd rpmbuild/BUILD/unpack && echo clementine-*)",
+              "python %(script)s rpmbuild/BUILD/unpack/$dir rpmbuild/BUILD/tree"
+              " bin",
+              "ln -s tree rpmbuild/BUILD/$dir",
+              "rm -rf rpmbuild/BUILD/unpack",
+          ]) % {
+              "topdir": topdir,
+              "target": " ".join(target),
+              "spec": spec,
+              "script": UPDATETREESCRIPT,
+          })))
+  if use_ccache:
+    _AddCcacheSetup(f, env)
   f.addStep(
-      shell.Compile(
+      Compile(
           name="rpmbuild",
-          workdir="source/bin",
+          workdir=".",
+          env=env,
           haltOnFailure=True,
-          command=["rpmbuild", "-ba", "../dist/clementine.spec"] + (["--target=i686-fedora-linux"] if not is_64_bit else [])))
-  f.addStep(OutputFinder(pattern="~/rpmbuild/RPMS/*/clementine-*.rpm"))
+          command=rpmbuild_cmd + noprep + ["-ba", spec]))
+  if use_ccache:
+    _AddCcacheStats(f, env)
+  f.addStep(
+      FindArtifacts([
+          "rpmbuild/RPMS/*/clementine-[0-9]*.rpm",
+          "rpmbuild/RPMS/*/clementine-debug*.rpm",
+          "rpmbuild/SRPMS/clementine-*.src.rpm",
+      ], workdir="."))
   f.addStep(UploadPackage("fedora-" + distro))
+  # Only the BUILD tree is reused, the rest of rpmbuild is fetched again or is
+  # output.
+  _AddSnapshotSave(f, ["rpmbuild/BUILD/tree"])
+  _AddBuildCache(f)
   return f
 
 
-def MakeSpotifyBlobBuilder():
+def MakeSpotifyBlobBuilder(is_64_bit, use_ccache=True):
+  env = {}
   cmake_cmd = [
       "cmake",
       "..",
       "-DCMAKE_INSTALL_PREFIX=source/bin/installprefix",
   ]
 
+  if use_ccache:
+    env = CcacheEnv("spotify-blob-%s" % ("64" if is_64_bit else "32"))
+    cmake_cmd += CCACHE_CMAKE_ARGS
+
   f = factory.BuildFactory()
-  f.addStep(git.Git(**GitArgs("Clementine")))
+  _AddGitCheckout(f, "Clementine", FULL_CHECKOUT)
+  _AddRemoveArtifacts(f, ["bin/spotify"])
   f.addStep(
       shell.ShellCommand(
           name="cmake",
           workdir="source/bin",
+          env=env,
           haltOnFailure=True,
           command=cmake_cmd))
+  if use_ccache:
+    _AddCcacheSetup(f, env)
   f.addStep(
-      shell.Compile(
+      Compile(
           workdir="source/bin",
+          env=env,
           haltOnFailure=True,
-          command=["make", "clementine-spotifyblob", "-j4"]))
+          command=["make", "clementine-spotifyblob", Jobs("-j%d")]))
+  if use_ccache:
+    _AddCcacheStats(f, env)
   f.addStep(
       shell.ShellCommand(
           name="install",
@@ -327,7 +1432,7 @@ def MakeSpotifyBlobBuilder():
           workdir="source/bin",
           haltOnFailure=True,
           command="strip spotify/version*/blob"))
-  f.addStep(OutputFinder(pattern="bin/spotify/version*-*bit"))
+  f.addStep(FindArtifacts(["bin/spotify/version*-*bit"], directories=True))
   f.addStep(
       shell.SetProperty(
           command=["echo", SPOTIFYBASE], property="spotifybase"))
@@ -339,12 +1444,14 @@ def MakeSpotifyBlobBuilder():
       -signature %(prop:spotifybase)s/%(prop:output-filename)s/blob.sha512 \
       %(prop:spotifybase)s/%(prop:output-filename)s/blob
   """)))
+  _AddSnapshotSave(f)
   return f
 
 
 def MakeMacBuilder():
   f = factory.BuildFactory()
-  f.addStep(git.Git(**GitArgs("Clementine")))
+  _AddGitCheckout(f, "Clementine", FULL_CHECKOUT)
+  _AddRemoveArtifacts(f, ["bin/clementine-*.dmg"])
   f.addStep(
       shell.ShellCommand(
           name="cmake",
@@ -372,8 +1479,9 @@ def MakeMacBuilder():
           ],
           haltOnFailure=True,))
   f.addStep(
-      shell.Compile(
-          command=["make"], workdir="source/bin", haltOnFailure=True))
+      Compile(
+          command=["make", Jobs("-j%d")], workdir="source/bin",
+          haltOnFailure=True))
   f.addStep(
       shell.ShellCommand(
           name="install",
@@ -392,14 +1500,38 @@ def MakeMacBuilder():
           command=["make", "dmg"],
           haltOnFailure=True,
           workdir="source/bin"))
-  f.addStep(OutputFinder(pattern="bin/clementine-*.dmg"))
+  f.addStep(FindArtifacts(["bin/clementine-*.dmg"]))
   f.addStep(UploadPackage("mac"))
+  _AddBuildCache(f)
   return f
 
 
-def MakeMacCrossBuilder():
+def MakeMacCrossBuilder(use_ccache=True):
+  env = {}
+  cmake_cmd = [
+      "cmake",
+      "..",
+      "-DCMAKE_TOOLCHAIN_FILE=/src/macosx/Toolchain-Darwin.cmake",
+      "-DCMAKE_OSX_ARCHITECTURES=x86_64",
+      "-DQT_HEADERS_DIR=/target/include",
+      "-DQT_LIBRARY_DIR=/target/lib",
+      "-DQT_BINARY_DIR=/target/bin",
+      "-DQT_USE_FRAMEWORKS=ON",
+      "-DQT_MKSPECS_DIR=/target/mkspecs",
+      "-DQT_QMAKE_EXECUTABLE=/target/bin/qmake",
+      "-DCMAKE_CFLAGS='-m64 -I/target/include --stdlib=libc++ -Qunused-arguments -isysroot /Developer/SDKs/MacOSX10.13.sdk'",
+      "-DCMAKE_CXXFLAGS='-m64 -I/target/include --stdlib=libc++ -Qunused-arguments -isysroot /Developer/SDKs/MacOSX10.13.sdk'",
+      "-DCMAKE_EXE_LINKER_FLAGS='-Wl,-syslibroot,/Developer/SDKs/MacOSX10.13.sdk -m64 -L/target/lib -lc++'",
+      "-DSPOTIFY=/target/libspotify.framework",
+  ]
+
+  if use_ccache:
+    env = CcacheEnv("mac-cross")
+    cmake_cmd += CCACHE_CMAKE_ARGS
+
   f = factory.BuildFactory()
-  f.addStep(git.Git(**GitArgs("Clementine")))
+  _AddGitCheckout(f, "Clementine", FULL_CHECKOUT)
+  _AddRemoveArtifacts(f, ["bin/clementine-*.dmg"])
   f.addStep(
       shell.ShellCommand(
           name="cmake",
@@ -408,26 +1540,16 @@ def MakeMacCrossBuilder():
               "PKG_CONFIG_PATH": "/target/lib/pkgconfig",
               "PATH": "/usr/bin:/bin:/target/bin",
           },
-          command=[
-              "cmake",
-              "..",
-              "-DCMAKE_TOOLCHAIN_FILE=/src/macosx/Toolchain-Darwin.cmake",
-              "-DCMAKE_OSX_ARCHITECTURES=x86_64",
-              "-DQT_HEADERS_DIR=/target/include",
-              "-DQT_LIBRARY_DIR=/target/lib",
-              "-DQT_BINARY_DIR=/target/bin",
-              "-DQT_USE_FRAMEWORKS=ON",
-              "-DQT_MKSPECS_DIR=/target/mkspecs",
-              "-DQT_QMAKE_EXECUTABLE=/target/bin/qmake",
-              "-DCMAKE_CFLAGS='-m64 -I/target/include --stdlib=libc++ -Qunused-arguments -isysroot /Developer/SDKs/MacOSX10.13.sdk'",
-              "-DCMAKE_CXXFLAGS='-m64 -I/target/include --stdlib=libc++ -Qunused-arguments -isysroot /Developer/SDKs/MacOSX10.13.sdk'",
-              "-DCMAKE_EXE_LINKER_FLAGS='-Wl,-syslibroot,/Developer/SDKs/MacOSX10.13.sdk -m64 -L/target/lib -lc++'",
-              "-DSPOTIFY=/target/libspotify.framework",
-          ],
+          command=cmake_cmd,
           haltOnFailure=True,))
+  if use_ccache:
+    _AddCcacheSetup(f, env)
   f.addStep(
-      shell.Compile(
-          command=["make"], workdir="source/bin", haltOnFailure=True))
+      Compile(
+          command=["make", Jobs("-j%d")], workdir="source/bin", env=env,
+          haltOnFailure=True))
+  if use_ccache:
+    _AddCcacheStats(f, env)
   f.addStep(
       shell.ShellCommand(
           name="install",
@@ -440,14 +1562,16 @@ def MakeMacCrossBuilder():
           command=["make", "dmg"],
           haltOnFailure=True,
           workdir="source/bin"))
-  f.addStep(OutputFinder(pattern="bin/clementine-*.dmg"))
+  f.addStep(FindArtifacts(["bin/clementine-*.dmg"]))
   f.addStep(UploadPackage("mac"))
+  _AddSnapshotSave(f)
+  _AddBuildCache(f)
   return f
 
 
 def MakeMacDepsBuilder():
   f = factory.BuildFactory()
-  f.addStep(git.Git(**GitArgs("Dependencies")))
+  _AddGitCheckout(f, "Dependencies", SHALLOW_CHECKOUT)
   f.addStep(
       shell.ShellCommand(
           name="clean", workdir="/src/macosx", command=["make", "clean"]))
@@ -528,7 +1652,8 @@ def _AddGithubSetup(f):
 
 def _MakeTransifexPoPullBuilder(repo, po_glob):
   f = factory.BuildFactory()
-  f.addStep(git.Git(**GitArgs(repo)))
+  # The translations are all it reads or commits.
+  _AddGitCheckout(f, repo, SparseCheckout(os.path.dirname(po_glob)))
   _AddTxSetupForRepo(f, repo, pot=False)
   _AddGithubSetup(f)
   f.addStep(
@@ -596,18 +1721,33 @@ def MakeAndroidTransifexPoPullBuilder():
                                      "app/src/main/res/values-*")
 
 
-def MakeTransifexPotPushBuilder():
+def MakeTransifexPotPushBuilder(use_ccache=True):
+  env = {}
+  cmake_cmd = ["cmake", ".."]
+  if use_ccache:
+    env = CcacheEnv("transifex")
+    cmake_cmd += CCACHE_CMAKE_ARGS
+
   f = factory.BuildFactory()
-  f.addStep(git.Git(**GitArgs("Clementine")))
+  # cmake runs git describe for the version.
+  _AddGitCheckout(f, "Clementine", FULL_CHECKOUT)
   f.addStep(
       shell.ShellCommand(
           name="cmake",
           haltOnFailure=True,
           workdir="source/bin",
-          command=["cmake", ".."]))
+          env=env,
+          command=cmake_cmd))
+  if use_ccache:
+    _AddCcacheSetup(f, env)
   f.addStep(
-      shell.Compile(
-          haltOnFailure=True, workdir="source/bin", command=["make", "-j4"]))
+      Compile(
+          haltOnFailure=True,
+          workdir="source/bin",
+          env=env,
+          command=["make", Jobs("-j%d")]))
+  if use_ccache:
+    _AddCcacheStats(f, env)
   _AddTxSetupForRepo(f, "Clementine")
   f.addStep(
       shell.ShellCommand(
@@ -615,12 +1755,14 @@ def MakeTransifexPotPushBuilder():
           workdir="source",
           haltOnFailure=True,
           command=["tx", "push", "-s"]))
+  _AddSnapshotSave(f)
   return f
 
 
 def MakeWebsiteTransifexPotPushBuilder():
   f = factory.BuildFactory()
-  f.addStep(git.Git(**GitArgs("Website")))
+  _AddGitCheckout(f, "Website",
+                  SparseCheckout("www.clementine-player.org/locale"))
   _AddTxSetupForRepo(f, "Website")
   f.addStep(
       shell.ShellCommand(
@@ -632,8 +1774,11 @@ def MakeWebsiteTransifexPotPushBuilder():
 
 
 def MakeAndroidRemoteBuilder():
+  artifacts = ["app/build/outputs/apk/release/ClementineRemote-release-*.apk"]
+
   f = factory.BuildFactory()
-  f.addStep(git.Git(**GitArgs("Android-Remote")))
+  _AddGitCheckout(f, "Android-Remote", BLOBLESS_CHECKOUT)
+  _AddRemoveArtifacts(f, artifacts)
 
   # Change path to properties file here
   sed_cmd = [
@@ -651,25 +1796,36 @@ def MakeAndroidRemoteBuilder():
           haltOnFailure=True,
           workdir="source",
           command=["./gradlew", "assembleRelease"]))
-  f.addStep(
-      OutputFinder(
-          pattern="app/build/outputs/apk/release/ClementineRemote-release-*.apk"))
+  f.addStep(FindArtifacts(artifacts))
   f.addStep(UploadPackage("android"))
+  _AddBuildCache(f)
   return f
 
 
-def MakeSourceBuilder():
-  git_args = GitArgs("Clementine")
-  git_args["mode"] = "full"
-  git_args["method"] = "fresh"
+def MakeSourceBuilder(schedulers):
+  """Makes the source tarball once per revision.
 
+  It's published for download and triggers the builders that package it.
+  Along with it goes a packaging tarball of the debian directory and the
+  generated RPM spec, which maketarball.sh leaves out.
+  """
   cmake_cmd = [
       "cmake",
       "..",
   ]
+  packaging_cmd = util.Interpolate(
+      "tar -cJf bin/clementine-packaging-%(prop:git-describe)s.tar.xz "
+      "debian dist/clementine.spec")
 
   f = factory.BuildFactory()
-  f.addStep(git.Git(**git_args))
+  _AddGitCheckout(f, "Clementine", FULL_CHECKOUT, mode="full", method="fresh")
+  f.addStep(
+      shell.SetPropertyFromCommand(
+          name="git describe",
+          command=["git", "describe"],
+          property="git-describe",
+          haltOnFailure=True,
+          workdir="source"))
   f.addStep(
       shell.ShellCommand(
           name="cmake",
@@ -678,9 +1834,23 @@ def MakeSourceBuilder():
           workdir="source/bin"))
   f.addStep(
       shell.ShellCommand(
+          name="maketarball",
           command=["./maketarball.sh"],
           haltOnFailure=True,
           workdir="source/dist"))
-  f.addStep(OutputFinder(pattern="dist/clementine-*.tar.xz"))
+  f.addStep(
+      shell.ShellCommand(
+          name="packaging",
+          command=packaging_cmd,
+          haltOnFailure=True,
+          workdir="source"))
+  f.addStep(
+      FindArtifacts([
+          "dist/clementine-*.tar.xz",
+          "bin/clementine-packaging-*.tar.xz",
+      ]))
   f.addStep(UploadPackage("source"))
+  f.addStep(PublishTarball())
+  f.addStep(TriggerTarballBuilders(schedulers))
+  _AddBuildCache(f, keep=("git describe", "publish tarball", "trigger"))
   return f
@@ -0,0 +1,112 @@
+import httplib
+import json
+import socket
+import urllib
+import urlparse
+
+# Seconds docker waits for a container to stop before killing it.
+STOP_TIMEOUT = 30
+REQUEST_TIMEOUT = 120
+
+
+class ContainerError(Exception):
+  pass
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+  """An HTTPConnection to a unix socket, like docker's."""
+
+  def __init__(self, socket_path, timeout):
+    httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+    self.socket_path = socket_path
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(self.timeout)
+    self.sock.connect(self.socket_path)
+
+
+class DockerBackend(object):
+  """Starts and stops slave containers through the Docker Engine API.
+
+  url is either unix:///var/run/docker.sock or http://host:port, which can
+  also be config/master/fake_docker.py.  The calls block, so the latent slaves
+  make them in a thread.
+  """
+
+  def __init__(self, url):
+    self.url = url
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme == 'unix':
+      self.connect = lambda: UnixHTTPConnection(parsed.path, REQUEST_TIMEOUT)
+    elif parsed.scheme == 'http':
+      self.connect = lambda: httplib.HTTPConnection(
+          parsed.netloc, timeout=REQUEST_TIMEOUT)
+    else:
+      raise ValueError('Unsupported docker URL %s' % url)
+
+  def __repr__(self):
+    return '<DockerBackend %s>' % self.url
+
+  def _Request(self, method, path, body=None, ignore=()):
+    connection = self.connect()
+    try:
+      headers = {}
+      if body is not None:
+        body = json.dumps(body)
+        headers['Content-Type'] = 'application/json'
+      connection.request(method, path, body, headers)
+      response = connection.getresponse()
+      data = response.read()
+    except (socket.error, httplib.HTTPException) as ex:
+      raise ContainerError('%s %s failed: %s' % (method, path, ex))
+    finally:
+      connection.close()
+
+    if response.status in ignore:
+      return None
+    if response.status >= 400:
+      raise ContainerError('%s %s failed with %d: %s' % (
+          method, path, response.status, data.strip()))
+    return json.loads(data) if data.strip() else None
+
+  def Start(self, name, image, environment, binds=(), volumes_from=(),
+            links=()):
+    """Starts a new container called name, replacing any old one left
+    behind."""
+    self.Remove(name)
+
+    host_config = {
+      'Binds': list(binds),
+      'VolumesFrom': list(volumes_from),
+      'Links': list(links),
+    }
+    self._Request('POST', '/containers/create?' + urllib.urlencode(
+        {'name': name}), {
+      'Image': image,
+      'Env': ['%s=%s' % item for item in sorted(environment.iteritems())],
+      'HostConfig': host_config,
+    })
+    self._Request('POST', '/containers/%s/start' % urllib.quote(name),
+                  ignore=(304,))
+
+  def Stop(self, name, fast=False):
+    self._Request('POST', '/containers/%s/stop?t=%d' % (
+        urllib.quote(name), 0 if fast else STOP_TIMEOUT), ignore=(304, 404))
+    self.Remove(name)
+
+  def Remove(self, name):
+    self._Request('DELETE', '/containers/%s?force=1' % urllib.quote(name),
+                  ignore=(404,))
+
+
+BACKENDS = {
+  'docker': DockerBackend,
+}
+
+
+def MakeBackend(config):
+  """Returns the backend named by config["type"], made with the rest of
+  config."""
+  config = dict((str(key), value) for key, value in config.iteritems())
+  return BACKENDS[config.pop('type', 'docker')](**config)
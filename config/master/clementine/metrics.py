@@ -0,0 +1,221 @@
+import collections
+import time
+
+from buildbot.status import base
+from buildbot.status import results
+from buildbot.util import datetime2epoch
+from twisted.python import log
+from twisted.web import resource
+from twisted.web import server
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = [1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200]
+
+
+class Histogram(object):
+
+  def __init__(self):
+    self.counts = [0] * len(BUCKETS)
+    self.count = 0
+    self.sum = 0.0
+
+  def Observe(self, value):
+    for i, bound in enumerate(BUCKETS):
+      if value <= bound:
+        self.counts[i] += 1
+    self.count += 1
+    self.sum += value
+
+
+# Keyed by (metric name, labels).  These outlive the Metrics receiver, see its
+# docstring.
+_COUNTERS = collections.defaultdict(float)
+_HISTOGRAMS = collections.defaultdict(Histogram)
+# Builds that haven't started their first step yet.
+_STARTING = set()
+
+
+def _Labels(labels):
+  return ",".join('%s="%s"' % (key, unicode(value).replace("\\", "\\\\")
+                               .replace('"', '\\"').replace("\n", "\\n"))
+                  for key, value in labels)
+
+
+class Metrics(base.StatusReceiverMultiService):
+  """Collects build metrics for MetricsResource to serve to Prometheus.
+
+  The startup time of a build is the time between it starting and its first
+  step starting.  It doesn't include waiting for locks: buildbot only starts a
+  build once its locks are available, so until then it shows up in the age of
+  the oldest request instead.
+
+  Buildbot replaces every status receiver when the config is reloaded, so the
+  counters and histograms are kept in this module instead, which isn't.
+  """
+
+  HELP = {
+    "clementine_builds_total": ("counter", "Finished builds"),
+    "clementine_build_duration_seconds": ("histogram", "Build durations"),
+    "clementine_build_startup_seconds": (
+        "histogram", "Time from a build starting to its first step"),
+    "clementine_step_duration_seconds": ("histogram", "Step durations"),
+    "clementine_upload_bytes_total": (
+        "counter", "Bytes the builds uploaded to the master"),
+    "clementine_change_lag_seconds": (
+        "histogram", "Time from a commit to the master seeing it"),
+  }
+
+  def __init__(self):
+    base.StatusReceiverMultiService.__init__(self)
+    self.master_status = None
+    self.builders = []
+
+  def setServiceParent(self, parent):
+    base.StatusReceiverMultiService.setServiceParent(self, parent)
+    self.master_status = self.parent.getStatus()
+    self.master_status.subscribe(self)
+    self.master = self.master_status.master
+
+  def disownServiceParent(self):
+    # The builders and their running builds would otherwise keep telling this
+    # receiver about them too, and count everything twice.
+    for builder in self.builders:
+      for build in builder.getCurrentBuilds():
+        build.unsubscribe(self)
+      if self in builder.watchers:
+        builder.unsubscribe(self)
+    self.builders = []
+    self.master_status.unsubscribe(self)
+    self.master_status = None
+    return base.StatusReceiverMultiService.disownServiceParent(self)
+
+  def builderAdded(self, name, builder):
+    self.builders.append(builder)
+    return self
+
+  def buildStarted(self, name, build):
+    _STARTING.add(build)
+    return self
+
+  def stepStarted(self, build, step):
+    if build in _STARTING:
+      _STARTING.discard(build)
+      _HISTOGRAMS[("clementine_build_startup_seconds", (
+          ("builder", build.getBuilder().getName()),))].Observe(
+              time.time() - build.getTimes()[0])
+
+  def stepFinished(self, build, step, result):
+    start, end = step.getTimes()
+    if start is None or end is None or result[0] == results.SKIPPED:
+      return
+    _HISTOGRAMS[("clementine_step_duration_seconds", (
+        ("builder", build.getBuilder().getName()),
+        ("step", step.getName())))].Observe(end - start)
+
+  def buildFinished(self, name, build, result):
+    _STARTING.discard(build)
+    _COUNTERS[("clementine_builds_total", (
+        ("builder", name), ("result", results.Results[result])))] += 1
+
+    start, end = build.getTimes()
+    _HISTOGRAMS[("clementine_build_duration_seconds", (
+        ("builder", name),))].Observe(end - start)
+
+    _COUNTERS[("clementine_upload_bytes_total", (
+        ("builder", name),))] += build.getProperty("upload-bytes", 0)
+
+  def changeAdded(self, change):
+    if change.when is not None:
+      _HISTOGRAMS[("clementine_change_lag_seconds", (
+          ("project", change.project),))].Observe(
+              max(0, time.time() - change.when))
+
+  def Render(self, requests):
+    """Returns the metrics in Prometheus' text format, with the gauges worked
+    out from the unclaimed build requests."""
+    now = time.time()
+    queued = collections.defaultdict(int)
+    oldest = {}
+    for request in requests:
+      name = request["buildername"]
+      queued[name] += 1
+      oldest[name] = min(oldest.get(name, now),
+                         datetime2epoch(request["submitted_at"]))
+
+    lines = []
+
+    def Header(name, kind, text):
+      lines.append("# HELP %s %s" % (name, text))
+      lines.append("# TYPE %s %s" % (name, kind))
+
+    Header("clementine_queued_requests", "gauge",
+           "Build requests waiting for a slave or locks")
+    for name in sorted(set(self.master_status.getBuilderNames()) |
+                       set(queued)):
+      lines.append("clementine_queued_requests{%s} %d" % (
+          _Labels([("builder", name)]), queued[name]))
+    Header("clementine_oldest_request_age_seconds", "gauge",
+           "Age of the oldest build request waiting for a slave or locks")
+    for name in sorted(oldest):
+      lines.append('clementine_oldest_request_age_seconds{%s} %.3f' % (
+          _Labels([("builder", name)]), now - oldest[name]))
+
+    Header("clementine_poll_age_seconds", "gauge",
+           "Time since the poller last fetched the repository")
+    # The master keeps its running pollers across reconfigs, unlike the ones
+    # the config made.
+    for poller in self.master.change_svc:
+      if getattr(poller, "last_poll", None) is not None:
+        lines.append("clementine_poll_age_seconds{%s} %.3f" % (
+            _Labels([("project", poller.project)]), now - poller.last_poll))
+
+    for metric in sorted(self.HELP):
+      kind, text = self.HELP[metric]
+      Header(metric, kind, text)
+      if kind == "counter":
+        for (name, labels), value in sorted(_COUNTERS.iteritems()):
+          if name == metric:
+            lines.append("%s{%s} %d" % (name, _Labels(labels), value))
+        continue
+
+      for (name, labels), histogram in sorted(_HISTOGRAMS.iteritems()):
+        if name != metric:
+          continue
+        for bound, count in zip(BUCKETS, histogram.counts):
+          lines.append("%s_bucket{%s} %d" % (
+              name, _Labels(labels + (("le", bound),)), count))
+        lines.append("%s_bucket{%s} %d" % (
+            name, _Labels(labels + (("le", "+Inf"),)), histogram.count))
+        lines.append("%s_sum{%s} %.3f" % (
+            name, _Labels(labels), histogram.sum))
+        lines.append("%s_count{%s} %d" % (
+            name, _Labels(labels), histogram.count))
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsResource(resource.Resource):
+  """Serves the Metrics to Prometheus."""
+
+  isLeaf = True
+
+  def __init__(self, metrics):
+    resource.Resource.__init__(self)
+    self.metrics = metrics
+
+  def render_GET(self, request):
+    d = self.metrics.master.db.buildrequests.getBuildRequests(claimed=False)
+
+    def Write(requests):
+      request.setHeader("Content-Type", "text/plain; version=0.0.4")
+      request.write(self.metrics.Render(requests).encode("utf-8"))
+      request.finish()
+
+    def Failed(failure):
+      log.err(failure, "while rendering metrics")
+      request.setResponseCode(500)
+      request.finish()
+
+    d.addCallback(Write)
+    d.addErrback(Failed)
+    return server.NOT_DONE_YET
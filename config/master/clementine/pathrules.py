@@ -0,0 +1,39 @@
+import fnmatch
+
+from buildbot import util
+
+
+class ChangeClassifier(util.ComparableMixin):
+  """Works out which builders need to run for the files a change touches.
+
+  rules is a list of (file pattern, builder patterns).  Each file uses the
+  first rule whose pattern matches it, and a file that doesn't match any rule
+  needs every builder, as does a change without a file list.
+
+  It's a fileIsImportant function too: a change is important if any of the
+  builders needs it.
+  """
+
+  compare_attrs = ["rules", "builder_names"]
+
+  def __init__(self, rules, builder_names):
+    self.rules = rules
+    self.builder_names = builder_names
+
+  def _BuilderPatterns(self, filename):
+    for pattern, builders in self.rules:
+      if fnmatch.fnmatch(filename, pattern):
+        return builders
+    return ["*"]
+
+  def Builders(self, files):
+    """Returns the builders that are needed by any of the files."""
+    patterns = set(["*"]) if not files else set()
+    for filename in files:
+      patterns.update(self._BuilderPatterns(filename))
+
+    return [name for name in self.builder_names
+            if any(fnmatch.fnmatch(name, x) for x in patterns)]
+
+  def __call__(self, change):
+    return bool(self.Builders(change.files))
@@ -0,0 +1,101 @@
+import cgi
+
+from buildbot.status import results
+from buildbot.util import formatInterval
+from twisted.internet import defer
+from twisted.web import resource
+
+
+class DurationHistory(object):
+  """Estimates how long each builder takes from its last successful builds.
+
+  Loading old builds means unpickling them from disk, so the durations are
+  cached until the builder finishes another build.
+  """
+
+  def __init__(self, size=10):
+    self.size = size
+    self.cache = {}
+
+  def Durations(self, builder_status):
+    name = builder_status.getName()
+    last = builder_status.getLastFinishedBuild()
+    key = last.getNumber() if last is not None else None
+    if name in self.cache and self.cache[name][0] == key:
+      return self.cache[name][1]
+
+    durations = []
+    for build in builder_status.generateFinishedBuilds(
+        num_builds=self.size, results=[results.SUCCESS, results.WARNINGS]):
+      start, end = build.getTimes()
+      if start is not None and end is not None:
+        durations.append(end - start)
+
+    self.cache[name] = (key, durations)
+    return durations
+
+  def Estimate(self, builder_status):
+    """Returns the median duration in seconds, or None without any history."""
+    durations = sorted(self.Durations(builder_status))
+    if not durations:
+      return None
+    return durations[len(durations) // 2]
+
+  @defer.inlineCallbacks
+  def PrioritizeBuilders(self, master, builders):
+    """A prioritizeBuilders function that starts the longest builds first.
+
+    Builders without any history yet go first, since they might be slow.
+    Ties are broken by the age of the oldest request like buildbot does.
+    """
+
+    def SortKey(builder, oldest):
+      estimate = self.Estimate(builder.builder_status)
+      return (estimate is not None, -(estimate or 0),
+              oldest is None, oldest)
+
+    keyed = []
+    for builder in builders:
+      oldest = yield builder.getOldestRequestTime()
+      keyed.append((SortKey(builder, oldest), builder))
+    keyed.sort(key=lambda x: x[0])
+    defer.returnValue([x[1] for x in keyed])
+
+
+class EstimatesResource(resource.Resource):
+  """Shows the order the builders would be started in and their estimates."""
+
+  isLeaf = True
+
+  def __init__(self, history):
+    resource.Resource.__init__(self)
+    self.history = history
+
+  def render_GET(self, request):
+    status = request.site.buildbot_service.master.status
+
+    rows = []
+    for name in status.getBuilderNames():
+      builder_status = status.getBuilder(name)
+      estimate = self.history.Estimate(builder_status)
+      count = len(self.history.Durations(builder_status))
+      rows.append((estimate is not None, -(estimate or 0), name, count))
+    rows.sort()
+
+    out = [
+        "<html><head><title>Build time estimates</title></head><body>",
+        "<h1>Build time estimates</h1>",
+        "<p>Queued builders are started in this order.  Estimates are the "
+        "median of the last %d successful builds.</p>" % self.history.size,
+        "<table border='1' cellpadding='4'>",
+        "<tr><th>Builder</th><th>Estimate</th><th>Builds</th></tr>",
+    ]
+    for has_estimate, estimate, name, count in rows:
+      out.append("<tr><td>%s</td><td>%s</td><td>%d</td></tr>" % (
+          cgi.escape(name),
+          formatInterval(int(-estimate)) if has_estimate else "unknown",
+          count))
+    out.append("</table></body></html>")
+
+    request.setHeader("Content-Type", "text/html; charset=utf-8")
+    return "\n".join(out).encode("utf-8")
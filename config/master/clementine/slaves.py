@@ -0,0 +1,105 @@
+from buildbot import buildslave
+from twisted.internet import defer
+from twisted.internet import threads
+from twisted.python import log
+
+# Files in the slave's info directory that are turned into slave properties,
+# and their types.  They are written by config/slave/start.py when the slave
+# starts.
+INFO_PROPERTIES = {
+  "cpus": ("slave-cpus", int),
+  "memory": ("slave-memory-mb", int),
+  "toolchain": ("slave-toolchain", str),
+  "distcc": ("slave-distcc", str),
+}
+
+
+class HostPropertiesMixin(object):
+  """Exposes the host's resources as slave properties.
+
+  Builds copy slave properties when they start, so factories can size their
+  compile steps with the slave-cpus and slave-memory-mb properties.
+  """
+
+  host_properties = {}
+
+  @defer.inlineCallbacks
+  def attached(self, bot):
+    try:
+      info = yield bot.callRemote("getSlaveInfo")
+    except Exception:
+      log.err(None, "Couldn't get host info from %s" % self.slavename)
+      info = {}
+
+    self.host_properties = {}
+    for key, (name, convert) in INFO_PROPERTIES.iteritems():
+      try:
+        self.host_properties[name] = convert(info[key].strip())
+      except (KeyError, AttributeError, ValueError):
+        pass
+    self._ApplyHostProperties()
+
+    result = yield super(HostPropertiesMixin, self).attached(bot)
+    defer.returnValue(result)
+
+  @defer.inlineCallbacks
+  def reconfigService(self, new_config):
+    yield super(HostPropertiesMixin, self).reconfigService(new_config)
+    # The properties are replaced by the ones from the new config.
+    self._ApplyHostProperties()
+
+  def _ApplyHostProperties(self):
+    for name, value in self.host_properties.iteritems():
+      self.properties.setProperty(name, value, "ClementineBuildSlave")
+
+
+class ClementineBuildSlave(HostPropertiesMixin, buildslave.BuildSlave):
+  """A slave that is always connected."""
+
+
+class ContainerBuildSlave(HostPropertiesMixin,
+                          buildslave.AbstractLatentBuildSlave):
+  """A slave whose container is only running while builds need it.
+
+  The container is started through backend when a build is queued for the
+  slave, and stopped once the slave has been idle for build_wait_timeout
+  seconds.
+  """
+
+  def __init__(self, name, password, backend, image, environment=None,
+               binds=(), volumes_from=(), links=(), **kwargs):
+    buildslave.AbstractLatentBuildSlave.__init__(
+        self, name, password, **kwargs)
+    self.backend = backend
+    self.image = image
+    self.environment = environment or {}
+    self.binds = binds
+    self.volumes_from = volumes_from
+    self.links = links
+
+  @property
+  def container_name(self):
+    return "buildbot-slave-%s" % self.slavename
+
+  def start_instance(self, build):
+    log.msg("Starting container %s from %s" % (
+        self.container_name, self.image))
+    d = threads.deferToThread(
+        self.backend.Start, self.container_name, self.image,
+        self.environment, binds=self.binds, volumes_from=self.volumes_from,
+        links=self.links)
+    d.addCallback(lambda _: True)
+    return d
+
+  def stop_instance(self, fast=False):
+    log.msg("Stopping container %s" % self.container_name)
+    return threads.deferToThread(
+        self.backend.Stop, self.container_name, fast=fast)
+
+  def reconfigService(self, new_config):
+    new = self.findNewSlaveInstance(new_config)
+    # Used the next time the container is started.
+    for name in ["backend", "image", "environment", "binds", "volumes_from",
+                 "links", "build_wait_timeout"]:
+      setattr(self, name, getattr(new, name))
+    return super(ContainerBuildSlave, self).reconfigService(new_config)
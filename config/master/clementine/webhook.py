@@ -0,0 +1,79 @@
+import hashlib
+import hmac
+import json
+import urlparse
+
+from twisted.python import log
+from twisted.web import resource
+
+
+class GitHubPushResource(resource.Resource):
+  """Receives GitHub push webhooks and polls the pushed repository at once.
+
+  The pollers stay the only source of changes, so a commit that arrives both
+  through a webhook and a regular poll is still only reported once.  They're
+  looked up in the master for every push: a reconfig replaces this resource
+  with the rest of the web status, but keeps the running pollers when they
+  haven't changed.
+  """
+
+  isLeaf = True
+
+  def __init__(self, secret=None):
+    resource.Resource.__init__(self)
+    self.secret = secret
+
+  def render_GET(self, request):
+    return "POST GitHub push events here.\n"
+
+  def render_POST(self, request):
+    body = request.content.read()
+
+    if self.secret is not None:
+      expected = "sha1=" + hmac.new(self.secret, body, hashlib.sha1).hexdigest()
+      signature = request.getHeader("X-Hub-Signature") or ""
+      if not hmac.compare_digest(signature, expected):
+        request.setResponseCode(403)
+        return "Bad signature\n"
+
+    event = request.getHeader("X-GitHub-Event") or "push"
+    if event == "ping":
+      return "pong\n"
+    if event != "push":
+      return "Ignoring %s event\n" % event
+
+    try:
+      payload = ParsePayload(request.getHeader("Content-Type"), body)
+      repository = payload["repository"]["name"].encode("utf-8")
+    except (AttributeError, KeyError, TypeError, ValueError):
+      request.setResponseCode(400)
+      return "Malformed push payload\n"
+
+    poller = FindPoller(request.site.buildbot_service.master,
+                        repository.lower())
+    if poller is None:
+      request.setResponseCode(404)
+      return "Not polling %s\n" % repository
+    if not poller.running:
+      request.setResponseCode(503)
+      return "The %s poller isn't running\n" % repository
+
+    log.msg("GitHub push to %s %s, polling now" %
+            (repository, payload.get("ref", "")))
+    poller.doPoll()
+    request.setResponseCode(202)
+    return "Polling %s\n" % repository
+
+
+def FindPoller(master, project):
+  """Returns the master's running change source that polls project."""
+  for source in master.change_svc:
+    if getattr(source, "project", None) == project and hasattr(source, "doPoll"):
+      return source
+  return None
+
+
+def ParsePayload(content_type, body):
+  if (content_type or "").startswith("application/x-www-form-urlencoded"):
+    body = urlparse.parse_qs(body)["payload"][0]
+  return json.loads(body)
@@ -0,0 +1,182 @@
+import time
+
+from buildbot import locks
+from buildbot.util.eventual import eventually
+
+# How long a refused build's reservation lasts without it asking again.
+RESERVATION_TIMEOUT = 30 * 60  # seconds
+
+
+class RealWeightedMasterLock(locks.BaseLock):
+  """A master lock whose owners each use up part of a shared capacity.
+
+  Buildbot doesn't start a build until its locks are available, so builds that
+  don't fit never queue up as waiters.  Instead the heaviest build that was
+  refused reserves its weight: lighter builds only start if they fit next to
+  it, so a stream of light builds can't starve a heavy one.  The reservation
+  goes once a build at least that heavy claims the lock, or when it hasn't been
+  refused again for RESERVATION_TIMEOUT, like when its request was cancelled.
+  """
+
+  def __init__(self, lockid):
+    locks.BaseLock.__init__(self, lockid.name, lockid.maxCount)
+    self.description = "<WeightedMasterLock(%s, %s)>" % (
+        self.name, self.maxCount)
+    self.reserved = 0
+    self.reserved_at = 0
+
+  def getLock(self, slave):
+    return self
+
+  def _Weight(self, access):
+    if access.mode == "exclusive":
+      return self.maxCount
+    return min(getattr(access, "weight", 1), self.maxCount)
+
+  def _UsedWeight(self):
+    return sum(self._Weight(access) for _, access in self.owners)
+
+  def _getOwnersCount(self):
+    # The base class asserts that there are at most maxCount owners, which
+    # doesn't hold once owners have weights.
+    num_excl = len([x for x in self.owners if x[1].mode == "exclusive"])
+    return num_excl, len(self.owners) - num_excl
+
+  def _Reservation(self, weight):
+    if (weight >= self.reserved or
+        time.time() - self.reserved_at > RESERVATION_TIMEOUT):
+      return 0
+    return self.reserved
+
+  def isAvailable(self, requester, access):
+    ahead = self.waiting
+    for idx, waiter in enumerate(self.waiting):
+      if waiter[0] == requester:
+        ahead = self.waiting[:idx]
+        break
+
+    weight = self._Weight(access)
+    reserved = sum(self._Weight(w[1]) for w in ahead)
+    available = (self._UsedWeight() + reserved + self._Reservation(weight) +
+                 weight <= self.maxCount)
+
+    # Buildbot asks without a requester before starting a build.
+    if not available and requester is None and not self._Reservation(weight):
+      self.reserved = weight
+      self.reserved_at = time.time()
+    return available
+
+  def claim(self, owner, access):
+    locks.BaseLock.claim(self, owner, access)
+    if self._Weight(access) >= self.reserved:
+      self.reserved = 0
+
+  def release(self, owner, access):
+    entry = (owner, access)
+    if entry not in self.owners:
+      return
+    self.owners.remove(entry)
+
+    # Wake up the waiters that fit in the freed capacity, in order.
+    used = self._UsedWeight()
+    for i, (w_owner, w_access, d) in enumerate(self.waiting):
+      used += self._Weight(w_access)
+      if used > self.maxCount:
+        break
+      if d:
+        self.waiting[i] = (w_owner, w_access, None)
+        eventually(d.callback, self)
+
+    self.release_subs.deliver()
+
+
+class WeightedLockAccess(locks.LockAccess):
+
+  compare_attrs = ["lockid", "mode", "weight"]
+
+  def __init__(self, lockid, weight):
+    locks.LockAccess.__init__(self, lockid, "counting")
+    self.weight = weight
+
+
+class WeightedMasterLock(locks.MasterLock):
+  """A MasterLock with a capacity instead of a maximum number of owners.
+
+  Builds take it with access(weight) and each one uses up that much of the
+  capacity while it runs.
+  """
+
+  lockClass = RealWeightedMasterLock
+
+  def __init__(self, name, capacity):
+    locks.MasterLock.__init__(self, name, maxCount=capacity)
+
+  def access(self, weight):
+    return WeightedLockAccess(self, weight)
+
+  def defaultAccess(self):
+    return self.access(1)
+
+
+class RealWeightedSlaveLock(object):
+  """Gives each slave its own RealWeightedMasterLock, with the capacity the
+  WeightedSlaveLock works out for the slave."""
+
+  def __init__(self, lockid):
+    self.lockid = lockid
+    self.name = lockid.name
+    self.description = "<WeightedSlaveLock(%s)>" % self.name
+    self.locks = {}
+
+  def __repr__(self):
+    return self.description
+
+  def getLock(self, slave):
+    capacity = self.lockid.Capacity(slave)
+    if slave.slavename not in self.locks:
+      self.locks[slave.slavename] = RealWeightedMasterLock(
+          WeightedMasterLock(self.name, capacity))
+    lock = self.locks[slave.slavename]
+
+    # The slave might have come back with different resources.
+    lock.maxCount = capacity
+    lock.description = "<WeightedSlaveLock(%s, %s)[%s]>" % (
+        self.name, capacity, slave.slavename)
+    return lock
+
+
+class WeightedSlaveLock(locks.SlaveLock):
+  """A WeightedMasterLock for each slave, sized from the slave's resources.
+
+  A slave's capacity is the number of CPUs it reported, limited to one for
+  every memory_per_cpu_mb of its memory.  capacities overrides it for some
+  slaves, and slaves that didn't report anything get default_capacity.
+  """
+
+  compare_attrs = locks.SlaveLock.compare_attrs + ["memory_per_cpu_mb"]
+  lockClass = RealWeightedSlaveLock
+
+  def __init__(self, name, default_capacity, memory_per_cpu_mb,
+               capacities=None):
+    locks.SlaveLock.__init__(self, name, maxCount=default_capacity,
+                             maxCountForSlave=capacities or {})
+    self.memory_per_cpu_mb = memory_per_cpu_mb
+
+  def Capacity(self, slave):
+    if slave.slavename in self.maxCountForSlave:
+      return self.maxCountForSlave[slave.slavename]
+
+    host = getattr(slave, "host_properties", {})
+    cpus = host.get("slave-cpus")
+    memory = host.get("slave-memory-mb")
+    if cpus is None:
+      return self.maxCount
+    if memory is not None:
+      cpus = min(cpus, memory // self.memory_per_cpu_mb)
+    return max(1, cpus)
+
+  def access(self, weight):
+    return WeightedLockAccess(self, weight)
+
+  def defaultAccess(self):
+    return self.access(1)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# Serves the part of the Docker Engine API that latent slaves use, running
+# each "container" as a local process instead.  Point a latent slave backend
+# at http://localhost:<port> to try latent slaves without docker:
+#
+#   fake_docker.py --command 'buildslave start --nodaemon /tmp/slaves/{image}'
+#
+# The command is formatted with the container's name and image, and runs with
+# the container's Env on top of this script's environment.  Containers and
+# their state are logged to stdout as they change.
+
+import argparse
+import BaseHTTPServer
+import json
+import os
+import shlex
+import signal
+import SocketServer
+import subprocess
+import sys
+import threading
+import time
+import urlparse
+
+
+class Container(object):
+  def __init__(self, name, config):
+    self.name = name
+    self.image = config.get('Image', '')
+    self.env = dict(x.split('=', 1) for x in config.get('Env') or [])
+    self.host_config = config.get('HostConfig') or {}
+    self.process = None
+
+  @property
+  def running(self):
+    return self.process is not None and self.process.poll() is None
+
+  def Start(self, command):
+    env = dict(os.environ)
+    env.update(self.env)
+    args = shlex.split(command.format(name=self.name, image=self.image))
+    self.process = subprocess.Popen(args, env=env)
+
+  def Stop(self, timeout):
+    if not self.running:
+      return
+    self.process.send_signal(signal.SIGTERM)
+    deadline = time.time() + timeout
+    while self.process.poll() is None and time.time() < deadline:
+      time.sleep(0.1)
+    if self.process.poll() is None:
+      self.process.kill()
+      self.process.wait()
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def _Reply(self, code, body=None):
+    data = json.dumps(body) if body is not None else ''
+    self.send_response(code)
+    if data:
+      self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def _Parse(self):
+    url = urlparse.urlparse(self.path)
+    query = dict(urlparse.parse_qsl(url.query))
+    # Clients can prefix the path with an API version.
+    components = [x for x in url.path.split('/') if x]
+    if components and components[0].startswith('v'):
+      components = components[1:]
+    return components, query
+
+  def do_GET(self):
+    components, _ = self._Parse()
+    if components != ['containers', 'json']:
+      return self._Reply(404, {'message': 'Not found'})
+    with self.server.lock:
+      self._Reply(200, [{
+        'Names': ['/' + x.name],
+        'Image': x.image,
+        'State': 'running' if x.running else 'exited',
+      } for x in self.server.containers.itervalues()])
+
+  def do_POST(self):
+    components, query = self._Parse()
+    length = int(self.headers.get('Content-Length', 0))
+    body = self.rfile.read(length) if length else ''
+    containers = self.server.containers
+
+    with self.server.lock:
+      if components == ['containers', 'create']:
+        name = query.get('name')
+        if not name:
+          return self._Reply(400, {'message': 'No name'})
+        if name in containers:
+          return self._Reply(409, {'message': 'Conflict: %s exists' % name})
+        containers[name] = Container(name, json.loads(body or '{}'))
+        self.server.Log('created', containers[name])
+        return self._Reply(201, {'Id': name, 'Warnings': []})
+
+      if len(components) != 3 or components[0] != 'containers':
+        return self._Reply(404, {'message': 'Not found'})
+      container = containers.get(components[1])
+      if container is None:
+        return self._Reply(404, {'message': 'No such container'})
+
+      if components[2] == 'start':
+        if container.running:
+          return self._Reply(304)
+        container.Start(self.server.command)
+        self.server.Log('started', container)
+        return self._Reply(204)
+
+      if components[2] == 'stop':
+        if not container.running:
+          return self._Reply(304)
+        container.Stop(int(query.get('t', 10)))
+        self.server.Log('stopped', container)
+        return self._Reply(204)
+
+    self._Reply(404, {'message': 'Not found'})
+
+  def do_DELETE(self):
+    components, query = self._Parse()
+    if len(components) != 2 or components[0] != 'containers':
+      return self._Reply(404, {'message': 'Not found'})
+
+    with self.server.lock:
+      container = self.server.containers.get(components[1])
+      if container is None:
+        return self._Reply(404, {'message': 'No such container'})
+      if container.running:
+        if query.get('force') not in ('1', 'true'):
+          return self._Reply(409, {'message': 'Container is running'})
+        container.Stop(0)
+      del self.server.containers[container.name]
+      self.server.Log('removed', container)
+    self._Reply(204)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def Log(self, event, container):
+    print '%s %s %s (%s)' % (time.strftime('%H:%M:%S'), event, container.name,
+                             container.image)
+    sys.stdout.flush()
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--port', type=int, default=2375)
+  parser.add_argument('--command', required=True,
+                      help='Command each container runs, formatted with '
+                           '{name} and {image}')
+  args = parser.parse_args()
+
+  server = Server(('', args.port), Handler)
+  server.command = args.command
+  server.containers = {}
+  server.lock = threading.Lock()
+  try:
+    server.serve_forever()
+  finally:
+    for container in server.containers.values():
+      container.Stop(0)
+
+
+if __name__ == '__main__':
+  main()
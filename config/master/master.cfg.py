@@ -4,32 +4,79 @@
 import functools
 import imp
 import json
+import multiprocessing
 import os
 import pprint
 import re
 
-from buildbot import buildslave
-from buildbot import locks
-from buildbot.schedulers import basic
 from buildbot.schedulers import filter
 from buildbot.schedulers import forcesched
 from buildbot.schedulers import timed
+from buildbot.schedulers import triggerable
 from buildbot.status import html
 from buildbot.status import mail
 from buildbot.status.web import authz
 
+from clementine import batching
 from clementine import builders
+from clementine import containers
+from clementine import metrics
+from clementine import pathrules
+from clementine import priority
+from clementine import slaves
+from clementine import weightedlock
+from clementine import webhook
 
 LINUX_FACTORIES = {
   'debian': functools.partial(builders.MakeDebBuilder, 'debian'),
   'ubuntu': functools.partial(builders.MakeDebBuilder, 'ubuntu'),
   'fedora': builders.MakeFedoraBuilder,
 }
+# Distros whose builders start from the Source builder's tarball instead of
+# each cloning the repository.
+TARBALL_DISTROS = ['fedora']
 DEV_PPA = 'ppa:me-davidsansome/clementine-dev'
 OFFICIAL_PPA = 'ppa:me-davidsansome/clementine'
-CONFIG = json.load(open('/config/config.json'))
-PASSWORDS = json.load(open('/config/passwords.json'))
-PASSWORDS.update(json.load(open('/config/passwords-external.json')))
+# check_config.py points this at its fixtures.
+CONFIG_DIR = os.environ.get('CLEMENTINE_CONFIG_DIR', '/config')
+CONFIG = json.load(open(os.path.join(CONFIG_DIR, 'config.json')))
+PASSWORDS = json.load(open(os.path.join(CONFIG_DIR, 'passwords.json')))
+PASSWORDS.update(json.load(open(
+    os.path.join(CONFIG_DIR, 'passwords-external.json'))))
+# Which builders a Clementine change needs, from the files it touches.  Each
+# file uses the first pattern it matches, and files that don't match any need
+# every builder.  Builder names can be patterns too.
+PATH_RULES = [
+  # Pulled from Transifex every day, they go out with the next code change.
+  ('src/translations/*.po', []),
+  ('*.md', []),
+  ('.github/*', []),
+  ('.travis.yml', []),
+  ('dist/windows/*', ['Windows *']),
+  ('dist/macdeploy.py', ['Mac *']),
+  # The Source builder triggers the Fedora and PPA builders.
+  ('debian/*', ['Debian *', 'Ubuntu *', 'Source']),
+  ('dist/clementine.spec.in', ['Source']),
+]
+# All the docker slaves share one host.  Each builder uses up some of its CPU
+# slots while it runs, and heavy compiles take half the host by default so two
+# of them can run at once.
+LOCAL_CAPACITY = int(CONFIG.get('local_capacity', multiprocessing.cpu_count()))
+HEAVY_COST = max(1, LOCAL_CAPACITY // 2)
+LIGHT_COST = 1
+# Slaves whose containers are only started when builds are queued for them.
+LATENT = CONFIG.get('latent', {})
+LATENT_SLAVES = set(LATENT.get('slaves', []))
+LATENT_IDLE_TIMEOUT = 10 * 60
+LOG_MAX_SIZE = 32 * 1024 * 1024
+LOG_MAX_TAIL_SIZE = 1024 * 1024
+WEBHOOK_SECRET = None
+if os.path.exists(os.path.join(CONFIG_DIR, 'github-webhook-secret')):
+  WEBHOOK_SECRET = open(
+      os.path.join(CONFIG_DIR, 'github-webhook-secret')).read().strip()
+# start.py --quiet leaves this file for the next load, which only logs a
+# summary instead of the whole config.
+QUIET_CONFIG_FILE = os.path.join(basedir, 'quiet-config')
 
 
 class ClementineBuildbot(object):
@@ -37,8 +84,20 @@ class ClementineBuildbot(object):
     self.slaves = []
     self.builders = []
     self.auto_builder_names = []
-    self.local_builder_lock = locks.MasterLock("local", maxCount=2)
-    self.deps_lock = locks.SlaveLock("deps", maxCount = 1)
+    # Triggered by the Source builder once it has made the tarball.
+    self.tarball_builder_names = []
+    self.local_builder_lock = weightedlock.WeightedMasterLock(
+        "local", capacity=LOCAL_CAPACITY)
+    # Each slave runs as many of its builders at once as fit in the CPUs and
+    # memory it reports, each using up its cost.
+    self.slave_lock = weightedlock.WeightedSlaveLock(
+        "slave", default_capacity=LOCAL_CAPACITY,
+        memory_per_cpu_mb=builders.MEMORY_PER_JOB_MB,
+        capacities=dict((str(name), int(capacity)) for name, capacity in
+                        CONFIG.get('slave_capacity', {}).iteritems()))
+    self.container_backend = None
+    if LATENT_SLAVES:
+      self.container_backend = containers.MakeBackend(LATENT['backend'])
 
     # Add linux slaves and builders.
     for linux_distro, versions in CONFIG['linux'].iteritems():
@@ -51,51 +110,52 @@ class ClementineBuildbot(object):
     for version in CONFIG['linux']['ubuntu']:
       self._AddBuilder(name='Ubuntu dev PPA %s' % version.title(),
                        slave='ubuntu-%s-32' % version,
-                       build_factory=builders.MakePPABuilder(version, DEV_PPA))
+                       build_factory=builders.MakePPABuilder(version, DEV_PPA),
+                       tarball=True,
+                       cost=LIGHT_COST)
       self._AddBuilder(name='Ubuntu official PPA %s' % version.title(),
                        slave='ubuntu-%s-32' % version,
                        build_factory=builders.MakePPABuilder(version, OFFICIAL_PPA),
-                       auto=False)
+                       auto=False,
+                       cost=LIGHT_COST)
 
     # Add special slaves.
     for name in CONFIG['special_slaves']:
       self._AddSlave(name)
 
     # Windows.
+    # The release build makes both the normal and the portable installer.
     self._AddBuilder(name='Windows Release',
                      slave='mingw',
-                     build_factory=builders.MakeWindowsBuilder(
-                         is_debug=False, is_portable=False),
-                     deps_lock='counting')
+                     build_factory=builders.MakeWindowsBuilder(is_debug=False),
+                     cross_compiled=True)
     self._AddBuilder(name='Windows Debug',
                      slave='mingw',
-                     build_factory=builders.MakeWindowsBuilder(
-                         is_debug=True, is_portable=False),
-                     deps_lock='counting')
-    self._AddBuilder(name='Windows Portable',
-                     slave='mingw',
-                     build_factory=builders.MakeWindowsBuilder(
-                         is_debug=False, is_portable=True),
-                     deps_lock='counting')
+                     build_factory=builders.MakeWindowsBuilder(is_debug=True),
+                     cross_compiled=True)
 
     # Mac.
     self._AddBuilder(name='Mac Cross',
                      slave='mac-cross',
-                     build_factory=builders.MakeMacCrossBuilder())
+                     build_factory=builders.MakeMacCrossBuilder(),
+                     cross_compiled=True)
 
     # Spotify.
     self._AddBuilder(name='Spofify blob 32-bit',
                      slave='spotify-blob-32',
-                     build_factory=builders.MakeSpotifyBlobBuilder())
+                     build_factory=builders.MakeSpotifyBlobBuilder(
+                         is_64_bit=False))
     self._AddBuilder(name='Spofify blob 64-bit',
                      slave='spotify-blob-64',
-                     build_factory=builders.MakeSpotifyBlobBuilder())
+                     build_factory=builders.MakeSpotifyBlobBuilder(
+                         is_64_bit=True))
 
     # Transifex.
     self._AddBuilder(name='Transifex Android PO pull',
                      slave='transifex',
                      build_factory=builders.MakeAndroidTransifexPoPullBuilder(),
-                     auto=False)
+                     auto=False,
+                     cost=LIGHT_COST)
 
     # Android.
     self._AddBuilder(name='Android Remote',
@@ -106,7 +166,8 @@ class ClementineBuildbot(object):
     # Source.
     self._AddBuilder(name='Source',
                      slave='ubuntu-xenial-64',
-                     build_factory=builders.MakeSourceBuilder())
+                     build_factory=builders.MakeSourceBuilder(['tarball']),
+                     cost=LIGHT_COST)
 
 
   def _AddBuilderAndSlave(self, distro, version, is_64_bit, factory):
@@ -116,18 +177,35 @@ class ClementineBuildbot(object):
         name='%s %s %s-bit' % (distro.title(), version.title(), bits),
         slave=slave,
         build_factory=factory(version, is_64_bit),
+        tarball=distro in TARBALL_DISTROS,
     )
     self._AddSlave(slave)
 
   def _AddBuilder(self, name, slave, build_factory,
                   auto=True,
+                  tarball=False,
                   local_lock=True,
-                  deps_lock=None):
-    locks = []
+                  jobs=None,
+                  cost=HEAVY_COST,
+                  cross_compiled=False):
+    cost = min(int(CONFIG.get('costs', {}).get(name, cost)), LOCAL_CAPACITY)
+    locks = [self.slave_lock.access(cost)]
     if local_lock:
-      locks.append(self.local_builder_lock.access('counting'))
-    if deps_lock is not None:
-      locks.append(self.deps_lock.access(deps_lock))
+      locks.append(self.local_builder_lock.access(cost))
+
+    # Compiles on idle slaves with the same toolchain too.  Slaves are matched
+    # on their native gcc, so cross compiled builders always compile locally.
+    if name in CONFIG.get('distcc', []) and not cross_compiled:
+      builders.DistributeCompiles(build_factory)
+
+    # Every build records what its shell steps used on the slave.
+    builders.ProfileSteps(build_factory)
+
+    # Overrides the number of compile jobs worked out from the slave's host.
+    properties = {'cpu-share': cost}
+    jobs = CONFIG.get('jobs', {}).get(name, jobs)
+    if jobs is not None:
+      properties['jobs'] = int(jobs)
 
     self.builders.append({
         'name':      str(name),
@@ -135,41 +213,83 @@ class ClementineBuildbot(object):
         'slavename': str(slave),
         'factory':   build_factory,
         'locks':     locks,
+        'properties': properties,
     })
 
-    if auto:
+    if tarball:
+      self.tarball_builder_names.append(name)
+    elif auto:
       self.auto_builder_names.append(name)
 
   def _AddSlave(self, name):
-    self.slaves.append(buildslave.BuildSlave(str(name), PASSWORDS[name]))
+    if name not in LATENT_SLAVES:
+      self.slaves.append(
+          slaves.ClementineBuildSlave(str(name), PASSWORDS[name]))
+      return
+
+    self.slaves.append(slaves.ContainerBuildSlave(
+        str(name), PASSWORDS[name],
+        backend=self.container_backend,
+        image=str(LATENT.get('image_prefix', '') + 'slave-' + name),
+        environment=LATENT.get('environment', {}),
+        binds=LATENT.get('binds', []),
+        volumes_from=LATENT.get('volumes_from', []),
+        links=LATENT.get('links', []),
+        build_wait_timeout=int(
+            LATENT.get('idle_timeout', LATENT_IDLE_TIMEOUT))))
 
   def Config(self):
+    pollers = [
+      builders.GitPoller("Android-Remote"),
+      builders.GitPoller("Clementine"),
+      builders.GitPoller("Dependencies"),
+      builders.GitPoller("Website"),
+    ]
+
+    web_status = html.WebStatus(
+      http_port="tcp:8010",
+      authz=authz.Authz(
+        forceBuild=True,
+        forceAllBuilds=True,
+        stopBuild=True,
+        stopAllBuilds=True,
+        cancelPendingBuild=True,
+        cancelAllPendingBuilds=True,
+        stopChange=True,
+      ),
+    )
+    # GitHub posts push events here, which makes the matching poller fetch
+    # straight away.
+    web_status.putChild(
+        'github', webhook.GitHubPushResource(secret=WEBHOOK_SECRET))
+
+    # Start the slowest builders first so they don't hold up the rest of the
+    # builds for a commit.
+    history = priority.DurationHistory()
+    web_status.putChild('estimates', priority.EstimatesResource(history))
+
+    # Queue, step, upload and poll metrics for Prometheus.
+    metrics_status = metrics.Metrics()
+    web_status.putChild('metrics', metrics.MetricsResource(metrics_status))
+
     return {
       'projectName':  "Clementine",
       'projectURL':   "http://www.clementine-player.org/",
       'buildbotURL':  "http://buildbot.clementine-player.org/",
       'slavePortnum': 9989,
+      # Logs are gzipped when their step finishes, which is quicker to serve
+      # than bz2.  Huge logs only keep their start and their tail, where the
+      # errors are.
+      'logCompressionMethod': 'gz',
+      'logMaxSize': LOG_MAX_SIZE,
+      'logMaxTailSize': LOG_MAX_TAIL_SIZE,
       'slaves': self.slaves,
       'builders': self.builders,
-      'change_source': [
-        builders.GitPoller("Android-Remote"),
-        builders.GitPoller("Clementine"),
-        builders.GitPoller("Dependencies"),
-        builders.GitPoller("Website"),
-      ],
+      'change_source': pollers,
+      'prioritizeBuilders': history.PrioritizeBuilders,
       'status': [
-        html.WebStatus(
-          http_port="tcp:8010",
-          authz=authz.Authz(
-            forceBuild=True,
-            forceAllBuilds=True,
-            stopBuild=True,
-            stopAllBuilds=True,
-            cancelPendingBuild=True,
-            cancelAllPendingBuilds=True,
-            stopChange=True,
-          ),
-        ),
+        web_status,
+        metrics_status,
         mail.MailNotifier(
           fromaddr="buildmaster@zaphod.purplehatstands.com",
           lookup="gmail.com",
@@ -177,24 +297,23 @@ class ClementineBuildbot(object):
         ),
       ],
       'schedulers': [
-        basic.SingleBranchScheduler(
+        batching.AdaptiveScheduler(
           name="automatic",
           change_filter=filter.ChangeFilter(project="clementine", branch="master"),
-          treeStableTimer=2*60,
+          classifier=pathrules.ChangeClassifier(
+            PATH_RULES, self.auto_builder_names),
           builderNames=self.auto_builder_names,
         ),
-        basic.SingleBranchScheduler(
+        batching.AdaptiveScheduler(
           name="qt5",
           change_filter=filter.ChangeFilter(project="clementine", branch="qt5"),
-          treeStableTimer=2*60,
           builderNames=[
             'Ubuntu Bionic 64-bit',
           ],
         ),
-        basic.SingleBranchScheduler(
+        batching.AdaptiveScheduler(
           name="android-remote",
           change_filter=filter.ChangeFilter(project="android-remote", branch="master"),
-          treeStableTimer=2*60,
           builderNames=[
             "Android Remote",
           ],
@@ -206,11 +325,29 @@ class ClementineBuildbot(object):
           revision=forcesched.FixedParameter(name="revision", default=""),
           repository=forcesched.FixedParameter(name="repository", default=""),
           project=forcesched.FixedParameter(name="project", default=""),
-          properties=[],
+          properties=[
+            # Throws away the state that incremental builders keep around.
+            forcesched.BooleanParameter(name="clean", label="Clean build",
+                                        default=False),
+            # Builds again even if the same inputs were built before.
+            forcesched.BooleanParameter(name="nocache",
+                                        label="Ignore the build cache",
+                                        default=False),
+          ],
           builderNames=[x['name'] for x in self.builders],
         ),
+        triggerable.Triggerable(
+          name="tarball",
+          builderNames=self.tarball_builder_names,
+        ),
       ],
     }
 
 BuildmasterConfig = ClementineBuildbot().Config()
-pprint.pprint(BuildmasterConfig)
+if os.path.exists(QUIET_CONFIG_FILE):
+  os.unlink(QUIET_CONFIG_FILE)
+  print 'Loaded %d builders, %d slaves and %d schedulers' % (
+      len(BuildmasterConfig['builders']), len(BuildmasterConfig['slaves']),
+      len(BuildmasterConfig['schedulers']))
+else:
+  pprint.pprint(BuildmasterConfig)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# Stands in for GitHub by posting a synthetic push event to the master's
+# webhook, e.g.
+#
+#   ./send_github_push.py --url http://localhost:8010/github Clementine
+#
+# With --reconfig it reloads the master's config first, to check that pushes
+# still reach the pollers the master kept running.
+
+import argparse
+import hashlib
+import hmac
+import json
+import subprocess
+import sys
+import time
+import urllib2
+
+parser = argparse.ArgumentParser()
+parser.add_argument('repository')
+parser.add_argument('--url', default='http://localhost:8010/github')
+parser.add_argument('--branch', default='master')
+parser.add_argument('--revision', default='0' * 40)
+parser.add_argument('--event', default='push')
+parser.add_argument('--secret-file')
+parser.add_argument('--reconfig', metavar='BASEDIR',
+                    help='Reconfig the master in BASEDIR before pushing')
+args = parser.parse_args()
+
+if args.reconfig:
+  subprocess.check_call(['buildbot', 'reconfig', args.reconfig])
+
+payload = {
+  'ref': 'refs/heads/' + args.branch,
+  'after': args.revision,
+  'repository': {
+    'name': args.repository,
+    'url': 'https://github.com/clementine-player/' + args.repository,
+  },
+  'head_commit': {
+    'id': args.revision,
+    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+  },
+}
+body = json.dumps(payload)
+
+headers = {
+  'Content-Type': 'application/json',
+  'X-GitHub-Event': args.event,
+}
+if args.secret_file:
+  secret = open(args.secret_file).read().strip()
+  headers['X-Hub-Signature'] = (
+      'sha1=' + hmac.new(secret, body, hashlib.sha1).hexdigest())
+
+try:
+  response = urllib2.urlopen(urllib2.Request(args.url, body, headers))
+except urllib2.HTTPError as ex:
+  response = ex
+
+print response.getcode(), response.read().strip()
+sys.exit(0 if response.getcode() < 400 else 1)
@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+# Simulates the build farm that master.cfg.py sets up, to try out lock sizes,
+# slave layouts and scheduler timers offline.  The config is loaded with
+# check_config.py's stubs, so the builders, locks and schedulers are the ones
+# production would get.
+#
+# Builds take the durations from --durations, a JSON file mapping builder names
+# to seconds or to {step name: seconds}, or the median of the last successful
+# builds in the master's --db.  The commits are replayed from --changes, a JSON
+# list of {"when", "project", "branch", "files"}, or the --db's last --days.
+#
+# The current config is always simulated.  Any of --capacity, --cost, --slave,
+# --stable-timer and --order simulate an alternative next to it.
+
+import argparse
+import collections
+import heapq
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+import check_config
+
+DEFAULT_DURATION = 10 * 60
+HISTORY_SIZE = 10
+
+
+class Request(object):
+
+  def __init__(self, builder, scheduler, project, branch, submitted):
+    self.builder = builder
+    self.scheduler = scheduler
+    self.project = project
+    self.branch = branch
+    self.submitted = submitted
+    self.started = None
+    self.lock_wait = 0
+
+
+class Build(object):
+
+  def __init__(self, builder, requests, started, duration):
+    self.builder = builder
+    self.requests = requests
+    self.started = started
+    self.finished = started + duration
+
+
+class Builder(object):
+  """The parts of a builder's config that the simulation needs."""
+
+  def __init__(self, config, duration):
+    self.name = config['name']
+    self.slave = config['slavename']
+    self.duration = duration
+    # (lock key, capacity, weight) for each lock the builder takes.
+    self.locks = [LockUse(x, self.slave) for x in config.get('locks', [])]
+    self.triggers = []
+    for step in config['factory'].steps:
+      if step.factory.__name__ == 'Trigger':
+        self.triggers.extend(step.kwargs.get('schedulerNames', []))
+    self.pending = []
+    self.running = None
+
+
+def LockUse(access, slave):
+  lock = access.lockid
+  capacity = lock.maxCount
+  if isinstance(lock, check_config.SlaveLock):
+    key = ('slave', lock.name, slave)
+    capacity = lock.maxCountForSlave.get(slave, capacity)
+  else:
+    key = ('master', lock.name)
+
+  weight = getattr(access, 'weight', None)
+  if weight is None:
+    weight = capacity if access.mode == 'exclusive' else 1
+  return key, capacity, min(weight, capacity)
+
+
+class Scheduler(object):
+  """An AdaptiveScheduler, or a Triggerable if it has no change filter."""
+
+  def __init__(self, scheduler):
+    kwargs = scheduler.stub_kwargs
+    self.name = kwargs['name']
+    self.builder_names = kwargs.get('builderNames', [])
+    self.change_filter = getattr(kwargs.get('change_filter'), 'stub_kwargs',
+                                 None)
+    self.classifier = getattr(scheduler, 'classifier', None)
+    self.min_timer = getattr(scheduler, 'minStableTimer',
+                             kwargs.get('treeStableTimer'))
+    self.max_timer = getattr(scheduler, 'maxStableTimer', self.min_timer)
+    self.rate_window = getattr(scheduler, 'rateWindow', 0)
+    self.per_change = getattr(scheduler, 'PER_CHANGE', 0)
+    self.per_request = getattr(scheduler, 'PER_REQUEST', 0)
+    self.change_times = []
+    self.changes = []
+    self.timer = None
+
+  def Matches(self, change):
+    if self.change_filter is None:
+      return False
+    return all(change.get(key) == value
+               for key, value in self.change_filter.iteritems())
+
+
+class Farm(object):
+  """Replays changes against builders, slaves, locks and schedulers."""
+
+  def __init__(self, config, durations, order):
+    self.order = order
+    self.builders = collections.OrderedDict()
+    for builder in config['builders']:
+      self.builders[builder['name']] = Builder(
+          builder, durations.get(builder['name'], DEFAULT_DURATION))
+    self.schedulers = dict(
+        (x.name, x) for x in
+        (Scheduler(s) for s in config['schedulers']
+         if type(s).__name__ in ('AdaptiveScheduler', 'SingleBranchScheduler',
+                                 'Triggerable')))
+    self.max_builds = dict(
+        (x.slavename, x.stub_kwargs.get('max_builds'))
+        for x in config['slaves'])
+
+    self.now = 0
+    self.events = []
+    self.sequence = 0
+    self.lock_used = collections.defaultdict(int)
+    self.lock_capacity = {}
+    self.slave_builds = collections.defaultdict(int)
+    self.lock_blocked = []
+
+    self.requests = []
+    self.superseded = 0
+    self.builds = []
+    self.slave_busy = collections.defaultdict(float)
+    self.lock_weight_time = collections.defaultdict(float)
+
+  def _Schedule(self, when, handler, *args):
+    self.sequence += 1
+    heapq.heappush(self.events, (when, self.sequence, handler, args))
+
+  def Run(self, changes):
+    for change in changes:
+      self._Schedule(change['when'], self._GotChange, change)
+
+    start = changes[0]['when'] if changes else 0
+    self.now = start
+    while self.events:
+      when, _, handler, args = heapq.heappop(self.events)
+      self._Advance(when)
+      handler(*args)
+      self._StartBuilds()
+    self.makespan = self.now - start
+
+  def _Advance(self, when):
+    elapsed = when - self.now
+    for builder in self.lock_blocked:
+      for request in builder.pending:
+        request.lock_wait += elapsed
+    for slave, count in self.slave_builds.iteritems():
+      if count:
+        self.slave_busy[slave] += elapsed
+    for key, used in self.lock_used.iteritems():
+      self.lock_weight_time[key] += used * elapsed
+    self.now = when
+
+  def _Queued(self, scheduler):
+    pending = sum(len(self.builders[x].pending)
+                  for x in scheduler.builder_names if x in self.builders)
+    return float(pending) / max(1, len(scheduler.builder_names))
+
+  def _GotChange(self, change):
+    for scheduler in self.schedulers.itervalues():
+      if not scheduler.Matches(change):
+        continue
+
+      important = (scheduler.classifier is None or
+                   bool(scheduler.classifier.Builders(change['files'])))
+      if not important and scheduler.timer is None:
+        continue
+      scheduler.changes.append(change)
+      if important:
+        scheduler.change_times.append(self.now)
+      scheduler.change_times = [x for x in scheduler.change_times
+                                if x >= self.now - scheduler.rate_window]
+
+      recent = max(0, len(scheduler.change_times) - 1)
+      timer = min(scheduler.max_timer,
+                  scheduler.min_timer + scheduler.per_change * recent +
+                  scheduler.per_request * self._Queued(scheduler))
+      scheduler.timer = object()
+      self._Schedule(self.now + timer, self._TimerFired, scheduler,
+                     scheduler.timer)
+
+  def _TimerFired(self, scheduler, timer):
+    if timer is not scheduler.timer:
+      return
+    changes, scheduler.changes, scheduler.timer = scheduler.changes, [], None
+
+    builder_names = scheduler.builder_names
+    if scheduler.classifier is not None:
+      files = []
+      if all(x['files'] for x in changes):
+        files = sum((x['files'] for x in changes), [])
+      builder_names = scheduler.classifier.Builders(files)
+
+    # Newer batches replace the scheduler's requests that haven't started.
+    for name in builder_names:
+      builder = self.builders[name]
+      kept = [x for x in builder.pending if x.scheduler != scheduler.name]
+      self.superseded += len(builder.pending) - len(kept)
+      builder.pending = kept
+
+    self._AddRequests(scheduler, builder_names, changes[-1]['project'],
+                      changes[-1]['branch'])
+
+  def _AddRequests(self, scheduler, builder_names, project, branch):
+    for name in builder_names:
+      request = Request(name, scheduler.name, project, branch, self.now)
+      self.builders[name].pending.append(request)
+      self.requests.append(request)
+
+  def _Prioritized(self):
+    builders = [x for x in self.builders.itervalues() if x.pending]
+    if self.order == 'longest':
+      key = lambda x: (-x.duration, x.pending[0].submitted)
+    else:
+      key = lambda x: x.pending[0].submitted
+    return sorted(builders, key=key)
+
+  def _LocksAvailable(self, builder):
+    for key, capacity, weight in builder.locks:
+      if self.lock_used[key] + weight > capacity:
+        return False
+    return True
+
+  def _StartBuilds(self):
+    self.lock_blocked = []
+    for builder in self._Prioritized():
+      if builder.running is not None:
+        continue
+      max_builds = self.max_builds.get(builder.slave)
+      if max_builds and self.slave_builds[builder.slave] >= max_builds:
+        continue
+      if not self._LocksAvailable(builder):
+        self.lock_blocked.append(builder)
+        continue
+
+      # Buildbot merges the requests for the same branch into one build.
+      first = builder.pending[0]
+      requests = [x for x in builder.pending
+                  if (x.project, x.branch) == (first.project, first.branch)]
+      builder.pending = [x for x in builder.pending if x not in requests]
+      for request in requests:
+        request.started = self.now
+
+      build = Build(builder, requests, self.now, builder.duration)
+      builder.running = build
+      self.builds.append(build)
+      self.slave_builds[builder.slave] += 1
+      for key, capacity, weight in builder.locks:
+        self.lock_used[key] += weight
+        self.lock_capacity[key] = capacity
+      self._Schedule(build.finished, self._BuildFinished, build)
+
+  def _BuildFinished(self, build):
+    builder = build.builder
+    builder.running = None
+    self.slave_builds[builder.slave] -= 1
+    for key, capacity, weight in builder.locks:
+      self.lock_used[key] -= weight
+
+    for name in builder.triggers:
+      scheduler = self.schedulers.get(name)
+      if scheduler is not None:
+        first = build.requests[0]
+        self._AddRequests(scheduler, scheduler.builder_names, first.project,
+                          first.branch)
+
+  def Report(self):
+    started = [x for x in self.requests if x.started is not None]
+    queue_waits = [x.started - x.submitted for x in started]
+    lock_waits = [x.lock_wait for x in started]
+    makespan = max(1, self.makespan)
+
+    report = collections.OrderedDict()
+    report['makespan'] = FormatDuration(self.makespan)
+    report['builds'] = str(len(self.builds))
+    report['requests'] = str(len(self.requests))
+    report['superseded requests'] = str(self.superseded)
+    report['mean queue wait'] = FormatDuration(Mean(queue_waits))
+    report['max queue wait'] = FormatDuration(max(queue_waits or [0]))
+    report['mean lock wait'] = FormatDuration(Mean(lock_waits))
+    report['max lock wait'] = FormatDuration(max(lock_waits or [0]))
+    for key in sorted(self.lock_capacity):
+      report['lock %s use' % ':'.join(key[1:])] = '%d%% of %d' % (
+          100 * self.lock_weight_time[key] / makespan /
+          self.lock_capacity[key], self.lock_capacity[key])
+    for slave in sorted(self.max_builds):
+      report['slave %s busy' % slave] = '%d%%' % (
+          100 * self.slave_busy[slave] / makespan)
+    return report
+
+
+def Mean(values):
+  return float(sum(values)) / len(values) if values else 0
+
+
+def FormatDuration(seconds):
+  seconds = int(seconds)
+  return '%dh%02dm%02ds' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def LoadDurations(path):
+  durations = {}
+  for name, value in json.load(open(path)).iteritems():
+    if isinstance(value, dict):
+      value = sum(value.itervalues())
+    durations[name] = value
+  return durations
+
+
+def DatabaseDurations(db):
+  """Median of each builder's last successful builds, like
+  priority.DurationHistory."""
+  history = collections.defaultdict(list)
+  for name, start, finish in db.execute(
+      'SELECT buildrequests.buildername, builds.start_time, '
+      'builds.finish_time FROM builds JOIN buildrequests '
+      'ON builds.brid = buildrequests.id '
+      'WHERE buildrequests.results IN (0, 1) AND builds.finish_time '
+      'IS NOT NULL ORDER BY builds.start_time DESC'):
+    if len(history[name]) < HISTORY_SIZE:
+      history[name].append(finish - start)
+
+  return dict((name, sorted(x)[len(x) // 2])
+              for name, x in history.iteritems())
+
+
+def DatabaseChanges(db, days):
+  rows = list(db.execute(
+      'SELECT changeid, when_timestamp, project, branch FROM changes '
+      'WHERE when_timestamp >= (SELECT MAX(when_timestamp) FROM changes) - ? '
+      'ORDER BY when_timestamp', (days * 24 * 60 * 60,)))
+  changes = []
+  for changeid, when, project, branch in rows:
+    files = [x[0] for x in db.execute(
+        'SELECT filename FROM change_files WHERE changeid = ?', (changeid,))]
+    changes.append({'when': when, 'project': project, 'branch': branch,
+                    'files': files})
+  return changes
+
+
+def LoadAlternative(config_dir, args):
+  """Loads the config again with the alternative capacity and costs, which
+  master.cfg.py reads from config.json."""
+  temp = tempfile.mkdtemp()
+  try:
+    for name in os.listdir(config_dir):
+      path = os.path.join(config_dir, name)
+      if os.path.isfile(path):
+        shutil.copy(path, temp)
+
+    config_json = json.load(open(os.path.join(temp, 'config.json')))
+    if args.capacity is not None:
+      config_json['local_capacity'] = args.capacity
+    for override in args.cost:
+      name, cost = override.rsplit('=', 1)
+      config_json.setdefault('costs', {})[name] = int(cost)
+    json.dump(config_json, open(os.path.join(temp, 'config.json'), 'w'))
+
+    config = check_config.LoadConfig(temp)
+  finally:
+    shutil.rmtree(temp)
+
+  builders = dict((x['name'], x) for x in config['builders'])
+  for override in args.slave:
+    name, slave = override.rsplit('=', 1)
+    if name not in builders:
+      sys.exit('Unknown builder %r' % name)
+    builders[name]['slavename'] = slave
+  return config
+
+
+def Simulate(config, durations, changes, order, stable_timer=None):
+  farm = Farm(config, durations, order)
+  if stable_timer is not None:
+    for scheduler in farm.schedulers.itervalues():
+      if scheduler.change_filter is not None:
+        scheduler.min_timer, scheduler.max_timer = stable_timer
+  farm.Run(changes)
+  return farm.Report()
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--config-dir',
+                      default=os.path.join(check_config.MASTER_DIR, 'fixtures'),
+                      help='Directory with config.json and the passwords')
+  parser.add_argument('--db', help="The master's state.sqlite")
+  parser.add_argument('--durations',
+                      help='JSON file with the duration of each builder')
+  parser.add_argument('--changes', help='JSON file with the changes to replay')
+  parser.add_argument('--days', type=float, default=7,
+                      help='Days of changes to replay from --db')
+  parser.add_argument('--capacity', type=int,
+                      help='Capacity of the local builder lock')
+  parser.add_argument('--cost', action='append', default=[],
+                      metavar='BUILDER=COST',
+                      help='How much of the local lock a builder uses')
+  parser.add_argument('--slave', action='append', default=[],
+                      metavar='BUILDER=SLAVE',
+                      help='Runs a builder on another slave')
+  parser.add_argument('--stable-timer', metavar='MIN,MAX',
+                      help="Seconds the schedulers wait for the tree")
+  parser.add_argument('--order', choices=['longest', 'oldest'],
+                      help='Start the longest builders or the oldest '
+                           'requests first (default: longest)')
+  args = parser.parse_args()
+
+  db = sqlite3.connect(args.db) if args.db else None
+  if args.durations:
+    durations = LoadDurations(args.durations)
+  elif db is not None:
+    durations = DatabaseDurations(db)
+  else:
+    durations = LoadDurations(os.path.join(
+        check_config.MASTER_DIR, 'fixtures', 'durations.json'))
+
+  if args.changes:
+    changes = json.load(open(args.changes))
+  elif db is not None:
+    changes = DatabaseChanges(db, args.days)
+  else:
+    changes = json.load(open(os.path.join(
+        check_config.MASTER_DIR, 'fixtures', 'changes.json')))
+  changes.sort(key=lambda x: x['when'])
+  for change in changes:
+    change.setdefault('files', [])
+
+  config_dir = os.path.abspath(args.config_dir)
+  check_config.InstallStubs()
+  config = check_config.LoadConfig(config_dir)
+  missing = [x['name'] for x in config['builders']
+             if x['name'] not in durations]
+  if missing:
+    print 'No durations for %s, using %s' % (
+        ', '.join(missing), FormatDuration(DEFAULT_DURATION))
+
+  results = [('current', Simulate(config, durations, changes, 'longest'))]
+  if (args.capacity is not None or args.cost or args.slave or
+      args.stable_timer or args.order):
+    stable_timer = None
+    if args.stable_timer:
+      stable_timer = [int(x) for x in args.stable_timer.split(',')]
+    results.append(('alternative', Simulate(
+        LoadAlternative(config_dir, args), durations, changes,
+        args.order or 'longest', stable_timer)))
+
+  print 'Replayed %d changes' % len(changes)
+  width = max(len(x) for x in results[0][1])
+  print '%-*s  %s' % (width, '', '  '.join('%12s' % x[0] for x in results))
+  for key in results[0][1]:
+    print '%-*s  %s' % (width, key, '  '.join(
+        '%12s' % x[1].get(key, '-') for x in results))
+
+
+if __name__ == '__main__':
+  main()
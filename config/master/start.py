@@ -3,13 +3,36 @@ import os
 import pwd
 import subprocess
 import sys
+import time
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--debug', action='store_true')
 parser.add_argument('--reconfig', action='store_true')
+parser.add_argument('--quiet', action='store_true',
+                    help="Don't dump the whole config into the master's log")
 args = parser.parse_args()
 
 BASEDIR = '/persistent-data/master'
+MIRRORDIR = os.path.join(BASEDIR, 'mirrors')
+UPLOADBASE = '/var/www/clementine-player.org/builds'
+# Next to UPLOADBASE on the same mount, so packages can be hard linked into it,
+# but not published.
+CASSTORE = '/var/www/clementine-player.org/cas'
+CASTOKENFILE = '/config/cas-token'
+RESTART_DELAY = 10  # seconds
+
+
+def Supervise(command):
+  """Runs command in a forked process that starts it again whenever it
+  exits."""
+  if os.fork():
+    return
+  while True:
+    code = subprocess.call(command)
+    sys.stderr.write('%s exited with %d, restarting in %ds\n' % (
+        command[0], code, RESTART_DELAY))
+    time.sleep(RESTART_DELAY)
+
 
 pwd_entry = pwd.getpwnam('buildbot')
 creating_basedir = False
@@ -28,11 +51,30 @@ if creating_basedir:
   subprocess.check_call(['buildbot', 'create-master', BASEDIR])
   os.symlink('/config/master/master.cfg.py', os.path.join(BASEDIR, 'master.cfg'))
 
+if args.quiet:
+  # master.cfg.py removes it again when it loads.
+  open(os.path.join(BASEDIR, 'quiet-config'), 'w').close()
+
 if not args.reconfig:
   pidfile = os.path.join(BASEDIR, 'twistd.pid')
   if os.path.exists(pidfile):
     os.unlink(pidfile)
 
+  # Serve the repository mirrors that the pollers keep up to date, so the
+  # slaves can fetch from the master instead of GitHub.
+  if not os.path.exists(MIRRORDIR):
+    os.mkdir(MIRRORDIR)
+  Supervise([
+      'git', 'daemon', '--reuseaddr', '--export-all',
+      '--base-path=' + MIRRORDIR, MIRRORDIR])
+
+  # Slaves upload their packages here rather than through buildbot.
+  Supervise([
+      sys.executable,
+      os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cas_server.py'),
+      '--root', UPLOADBASE, '--store', CASSTORE,
+      '--token-file', CASTOKENFILE])
+
 if args.debug:
   argv = ['buildbot', 'start', BASEDIR]
 elif args.reconfig:
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# Downloads a blob from the master's cas_server.py by its sha256.  The file is
+# only written once its content matches, and nothing is downloaded if the
+# output already has the right content.
+
+import argparse
+import hashlib
+import httplib
+import os
+import sys
+import time
+import urlparse
+
+CHUNK_SIZE = 1024 * 1024
+ATTEMPTS = 5
+
+
+class FetchError(Exception):
+  pass
+
+
+def Sha256(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as fh:
+    for chunk in iter(lambda: fh.read(CHUNK_SIZE), ''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def Download(server, sha256, output):
+  url = urlparse.urlparse(server)
+  temp = output + '.tmp'
+
+  for attempt in range(ATTEMPTS):
+    try:
+      conn = httplib.HTTPConnection(url.hostname, url.port or 80,
+                                    timeout=5 * 60)
+      conn.request('GET', '/blobs/' + sha256)
+      response = conn.getresponse()
+      if response.status != 200:
+        raise FetchError('Fetching %s failed: %d %s' % (
+            sha256, response.status, response.read().strip()))
+
+      digest = hashlib.sha256()
+      with open(temp, 'wb') as fh:
+        for chunk in iter(lambda: response.read(CHUNK_SIZE), ''):
+          digest.update(chunk)
+          fh.write(chunk)
+
+      if digest.hexdigest() == sha256:
+        os.rename(temp, output)
+        return
+      print 'Download of %s was corrupted' % sha256
+    except (httplib.HTTPException, IOError) as ex:
+      print 'Download interrupted: %s' % ex
+
+    time.sleep(2 ** attempt)
+
+  raise FetchError('Giving up on %s after %d attempts' % (sha256, ATTEMPTS))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--server', default='http://%s:8011' %
+                      os.environ.get('MASTER_PORT_9989_TCP_ADDR', 'localhost'))
+  parser.add_argument('--sha256', required=True)
+  parser.add_argument('output')
+  args = parser.parse_args()
+
+  if os.path.exists(args.output) and Sha256(args.output) == args.sha256:
+    print '%s is already there' % args.output
+    return
+
+  directory = os.path.dirname(args.output)
+  if directory and not os.path.exists(directory):
+    os.makedirs(directory)
+  try:
+    Download(args.server, args.sha256, args.output)
+  except FetchError as ex:
+    sys.exit(str(ex))
+  print 'fetched: %s %s' % (os.path.basename(args.output), args.sha256)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# Uploads build artifacts to the master's cas_server.py and publishes each one
+# as <directory>/<name>.  A file is only sent if the master doesn't have a blob
+# with the same sha256 yet, and interrupted uploads carry on where they
+# stopped.  Several files are uploaded at the same time.  The uploads are
+# authorized with the token in --token-file.
+
+import argparse
+import hashlib
+import httplib
+import os
+import sys
+import threading
+import time
+import urlparse
+
+CHUNK_SIZE = 1024 * 1024
+ATTEMPTS = 5
+
+
+class UploadError(Exception):
+  pass
+
+
+output_lock = threading.Lock()
+
+
+def Log(message):
+  # Uploads run in several threads, so whole lines are written at once.
+  with output_lock:
+    sys.stdout.write(message + '\n')
+    sys.stdout.flush()
+
+
+def Sha256(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as fh:
+    for chunk in iter(lambda: fh.read(CHUNK_SIZE), ''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+class Client(object):
+  def __init__(self, url, token):
+    self.url = urlparse.urlparse(url)
+    self.authorization = 'Bearer ' + token
+
+  def Request(self, method, path, body=None):
+    conn = httplib.HTTPConnection(self.url.hostname, self.url.port or 80,
+                                  timeout=5 * 60)
+    conn.request(method, path, body, {'Authorization': self.authorization})
+    response = conn.getresponse()
+    return response, response.read()
+
+  def Put(self, path, fh, offset, total):
+    conn = httplib.HTTPConnection(self.url.hostname, self.url.port or 80,
+                                  timeout=5 * 60)
+    conn.putrequest('PUT', path)
+    conn.putheader('Authorization', self.authorization)
+    conn.putheader('Upload-Offset', str(offset))
+    conn.putheader('Upload-Length', str(total))
+    conn.putheader('Content-Length', str(total - offset))
+    conn.endheaders()
+
+    fh.seek(offset)
+    for chunk in iter(lambda: fh.read(CHUNK_SIZE), ''):
+      conn.send(chunk)
+    response = conn.getresponse()
+    return response, response.read()
+
+
+def Upload(client, path, sha256):
+  """Returns the number of bytes sent."""
+  blob_path = '/blobs/' + sha256
+  total = os.path.getsize(path)
+
+  for attempt in range(ATTEMPTS):
+    try:
+      response, _ = client.Request('HEAD', blob_path)
+      if response.status == 200:
+        return 0
+      offset = int(response.getheader('Upload-Offset', 0))
+      if offset:
+        Log('Resuming upload at %d of %d bytes' % (offset, total))
+
+      with open(path, 'rb') as fh:
+        response, body = client.Put(blob_path, fh, offset, total)
+      if response.status in (200, 201):
+        return total - offset
+      Log('Upload failed: %d %s' % (response.status, body.strip()))
+      if response.status == 422:
+        raise UploadError('%s changed while it was uploaded' % path)
+    except (httplib.HTTPException, IOError) as ex:
+      Log('Upload interrupted: %s' % ex)
+
+    time.sleep(2 ** attempt)
+
+  raise UploadError('Giving up on %s after %d attempts' % (path, ATTEMPTS))
+
+
+def UploadAndPublish(client, path, directory, name):
+  sha256 = Sha256(path)
+  sent = Upload(client, path, sha256)
+
+  response, body = client.Request(
+      'POST', '/links/%s/%s' % (directory.strip('/'), name), sha256)
+  if response.status != 201:
+    raise UploadError('Publishing %s failed: %d %s' % (
+        name, response.status, body.strip()))
+  # Parsed by the CasUpload step on the master.
+  Log('uploaded: %s %s %d' % (name, sha256, sent))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--server', default='http://%s:8011' %
+                      os.environ.get('MASTER_PORT_9989_TCP_ADDR', 'localhost'))
+  parser.add_argument('--directory', required=True)
+  parser.add_argument('--token-file', default='/config/cas-token')
+  parser.add_argument('--jobs', type=int, default=4)
+  parser.add_argument('paths', nargs='+')
+  args = parser.parse_args()
+
+  if not os.path.exists(args.token_file):
+    sys.exit('No upload token in %s' % args.token_file)
+  client = Client(args.server, open(args.token_file).read().strip())
+  pending = list(args.paths)
+  errors = []
+  lock = threading.Lock()
+
+  def Worker():
+    while True:
+      with lock:
+        if not pending:
+          return
+        path = pending.pop(0)
+      try:
+        UploadAndPublish(client, path, args.directory, os.path.basename(path))
+      except Exception as ex:
+        with lock:
+          errors.append(ex)
+        Log('Failed to upload %s: %s' % (path, ex))
+
+  threads = [threading.Thread(target=Worker)
+             for _ in range(min(args.jobs, len(pending)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  if errors:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
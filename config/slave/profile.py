@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# Runs a build step's command and measures what its process tree used: CPU
+# time, peak memory, disk I/O, context switches and page faults.  The numbers
+# are written to --output as "name value" lines once the command exits, and
+# the command's exit code is passed on.
+
+import argparse
+import glob
+import os
+import signal
+import subprocess
+import sys
+import time
+
+SAMPLE_INTERVAL = 1  # seconds
+# Profiles of old builds are removed from the output's directory.
+STALE_AGE = 24 * 60 * 60
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+MB = 1024.0 * 1024
+
+
+def TreeRss(root):
+  """Returns the resident memory of root and its descendants in bytes, or
+  None without /proc."""
+  if not os.path.exists('/proc/self/stat'):
+    return None
+
+  parents = {}
+  rss = {}
+  for path in glob.glob('/proc/[0-9]*/stat'):
+    try:
+      with open(path) as fh:
+        stat = fh.read()
+    except IOError:
+      continue
+    pid = int(path.split('/')[2])
+    # The command name can contain spaces, the other fields can't.
+    fields = stat[stat.rindex(')') + 2:].split()
+    parents[pid] = int(fields[1])
+    rss[pid] = int(fields[21]) * PAGE_SIZE
+
+  total = 0
+  for pid in rss:
+    ancestor = pid
+    while ancestor not in (root, 0, 1) and ancestor in parents:
+      ancestor = parents[ancestor]
+    if ancestor == root:
+      total += rss[pid]
+  return total
+
+
+def RemoveStaleProfiles(output):
+  pattern = os.path.join(os.path.dirname(output) or '.', 'buildbot-profile-*')
+  for path in glob.glob(pattern):
+    try:
+      if os.path.getmtime(path) < time.time() - STALE_AGE:
+        os.unlink(path)
+    except OSError:
+      pass
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--output', required=True)
+  parser.add_argument('command', nargs=argparse.REMAINDER)
+  args = parser.parse_args()
+  command = args.command[1:] if args.command[:1] == ['--'] else args.command
+
+  RemoveStaleProfiles(args.output)
+  if os.path.exists(args.output):
+    os.unlink(args.output)
+
+  start = time.time()
+  child = subprocess.Popen(command)
+
+  def Forward(signum, frame):
+    child.send_signal(signum)
+  for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+    signal.signal(signum, Forward)
+  # Wakes up the sleep below when the command exits.
+  signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+  peak_rss = None
+  while True:
+    try:
+      pid, status, usage = os.wait4(child.pid, os.WNOHANG)
+    except OSError:
+      # Interrupted by a signal.
+      continue
+    if pid:
+      break
+    rss = TreeRss(child.pid)
+    if rss is not None and (peak_rss is None or rss > peak_rss):
+      peak_rss = rss
+    time.sleep(SAMPLE_INTERVAL)
+  wall = time.time() - start
+
+  if os.WIFSIGNALED(status):
+    exit_code = 128 + os.WTERMSIG(status)
+  else:
+    exit_code = os.WEXITSTATUS(status)
+
+  # ru_maxrss is in bytes on Mac OS X and in kilobytes everywhere else.
+  max_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+  cpu = usage.ru_utime + usage.ru_stime
+  profile = [
+      ('wall-seconds', '%.1f' % wall),
+      ('cpu-user-seconds', '%.1f' % usage.ru_utime),
+      ('cpu-system-seconds', '%.1f' % usage.ru_stime),
+      # How many CPUs the command kept busy on average.
+      ('cpu-parallelism', '%.2f' % (cpu / wall if wall else 0)),
+      ('peak-rss-mb', '%.0f' % (peak_rss / MB) if peak_rss else None),
+      ('max-process-rss-mb', '%.0f' % (max_rss / MB)),
+      # ru_inblock and ru_oublock count 512 byte blocks.
+      ('read-mb', '%.1f' % (usage.ru_inblock * 512 / MB)),
+      ('write-mb', '%.1f' % (usage.ru_oublock * 512 / MB)),
+      ('voluntary-switches', usage.ru_nvcsw),
+      ('involuntary-switches', usage.ru_nivcsw),
+      ('major-faults', usage.ru_majflt),
+      ('exit-code', exit_code),
+  ]
+  with open(args.output, 'w') as fh:
+    for name, value in profile:
+      if value is not None:
+        fh.write('%s %s\n' % (name, value))
+
+  sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+  main()
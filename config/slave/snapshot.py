@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# Saves and restores builders' working copies in the master's cas_server.py,
+# so a slave that lost its /persistent-data, or was moved to another node, can
+# carry on building incrementally.
+#
+#   snapshot.py save <builder name> [path...]
+#                                     Run from a builder's directory after a
+#                                     successful build.  Saves the source
+#                                     directory unless other paths are given.
+#   snapshot.py restore <basedir>     Run by start.py before the slave
+#                                     connects.
+#
+# Nothing happens unless SNAPSHOT_SERVER is set to the URL of cas_server.py.
+
+import httplib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import cas_fetch
+import cas_upload
+
+SNAPSHOT_SERVER = os.environ.get('SNAPSHOT_SERVER')
+TOKEN_FILE = '/config/cas-token'
+SNAPSHOT_PATHS = ['source']
+# Packages are uploaded and made again by every build, so they aren't saved.
+SNAPSHOT_EXCLUDES = ['*.deb', '*.rpm', '*.exe', '*.dmg', '*.apk', '*.tar.xz',
+                     '_CPack_Packages']
+# A builder's snapshot is only replaced once it's this old.  The next build
+# after a restore catches up with whatever changed since.
+SAVE_INTERVAL = 12 * 60 * 60  # seconds
+MAX_AGE = 7 * 24 * 60 * 60  # seconds
+
+
+def SlaveName():
+  if os.path.exists('/slave-name'):
+    return open('/slave-name').read().strip()
+  return socket.gethostname()
+
+
+def Client():
+  with open(TOKEN_FILE) as fh:
+    return cas_upload.Client(SNAPSHOT_SERVER, fh.read().strip())
+
+
+def Snapshots(client):
+  response, body = client.Request('GET', '/snapshots/%s' % SlaveName())
+  if response.status != 200:
+    raise cas_upload.UploadError('Listing snapshots failed: %d %s' % (
+        response.status, body.strip()))
+  return json.loads(body)
+
+
+def Dissociate(path, tempdir):
+  """Clones made with --reference only work while the reference repository is
+  there, so the snapshot gets a copy of their .git with its own objects.  The
+  working copy keeps borrowing them.  Returns whether path had to be copied."""
+  gitdir = os.path.join(path, '.git')
+  if not os.path.exists(os.path.join(gitdir, 'objects', 'info', 'alternates')):
+    return False
+  copy = os.path.join(tempdir, path, '.git')
+  os.makedirs(os.path.dirname(copy))
+  subprocess.check_call(['cp', '-a', gitdir, copy])
+  subprocess.check_call(
+      ['git', '--git-dir=' + copy, 'repack', '-a', '-d', '-q'])
+  os.unlink(os.path.join(copy, 'objects', 'info', 'alternates'))
+  return True
+
+
+def Save(buildername, paths):
+  builddir = os.path.basename(os.getcwd())
+  paths = [x for x in paths or SNAPSHOT_PATHS if os.path.exists(x)]
+  if not paths:
+    print 'Nothing to snapshot'
+    return
+
+  client = Client()
+  last = Snapshots(client).get(builddir)
+  if (last is not None and last.get('paths') == paths and
+      time.time() - last.get('time', 0) < SAVE_INTERVAL):
+    print 'The last snapshot is recent enough'
+    return
+
+  tempdir = tempfile.mkdtemp(prefix='snapshot-',
+                             dir=os.path.dirname(os.getcwd()))
+  archive = os.path.join(tempdir, 'snapshot.tar.gz')
+  try:
+    dissociated = [x for x in paths if Dissociate(x, tempdir)]
+    tar = os.path.join(tempdir, 'snapshot.tar')
+    subprocess.check_call(
+        ['tar', '-cf', tar] +
+        ['--exclude=%s' % x for x in SNAPSHOT_EXCLUDES] +
+        ['--exclude=%s/.git' % x for x in dissociated] + paths)
+    for path in dissociated:
+      subprocess.check_call(
+          ['tar', '-rf', tar, '-C', tempdir, os.path.join(path, '.git')])
+    subprocess.check_call(['gzip', '-n', tar])
+    sha256 = cas_upload.Sha256(archive)
+    cas_upload.Upload(client, archive, sha256)
+    info = json.dumps({
+        'builder': buildername,
+        'basedir': os.path.dirname(os.getcwd()),
+        'time': time.time(),
+        'paths': paths,
+        'sha256': sha256,
+        'size': os.path.getsize(archive),
+    })
+    response, body = client.Request(
+        'PUT', '/snapshots/%s/%s' % (SlaveName(), builddir), info)
+    if response.status != 201:
+      raise cas_upload.UploadError('Saving the snapshot failed: %d %s' % (
+          response.status, body.strip()))
+    print 'Saved %s (%d MB)' % (sha256, os.path.getsize(archive) // 2**20)
+  finally:
+    shutil.rmtree(tempdir)
+
+
+def IsFresh(info, basedir, builddir):
+  if info.get('basedir') != basedir:
+    return 'it was made in %s' % info.get('basedir')
+  if time.time() - info.get('time', 0) > MAX_AGE:
+    return 'it is too old'
+  for path in info.get('paths', SNAPSHOT_PATHS):
+    if os.path.exists(os.path.join(basedir, builddir, path)):
+      return 'the working copy is already there'
+  return None
+
+
+def Restore(basedir):
+  try:
+    snapshots = Snapshots(Client())
+  except (cas_upload.UploadError, httplib.HTTPException, IOError,
+          ValueError) as ex:
+    print 'Not restoring snapshots: %s' % ex
+    return
+
+  for builddir, info in sorted(snapshots.iteritems()):
+    reason = IsFresh(info, basedir, builddir)
+    if reason is not None:
+      print 'Not restoring %s: %s' % (info.get('builder', builddir), reason)
+      continue
+
+    target = os.path.join(basedir, builddir)
+    if not os.path.exists(target):
+      os.mkdir(target)
+    archive = os.path.join(basedir, 'snapshot-%s.tar.gz' % builddir)
+    try:
+      cas_fetch.Download(SNAPSHOT_SERVER, info['sha256'], archive)
+      subprocess.check_call(['tar', '-xzf', archive, '-C', target])
+    except (cas_fetch.FetchError, subprocess.CalledProcessError) as ex:
+      print 'Failed to restore %s: %s' % (info['builder'], ex)
+      for path in info.get('paths', SNAPSHOT_PATHS):
+        shutil.rmtree(os.path.join(target, path), ignore_errors=True)
+      continue
+    finally:
+      if os.path.exists(archive):
+        os.unlink(archive)
+    print 'Restored %s' % info['builder']
+
+
+def main():
+  if not SNAPSHOT_SERVER:
+    print 'SNAPSHOT_SERVER is not set, not using snapshots'
+    return
+  if (len(sys.argv) < 3 or sys.argv[1] not in ('save', 'restore') or
+      (sys.argv[1] == 'restore' and len(sys.argv) != 3)):
+    sys.exit('Usage: %s save <builder name> [path...] | restore <basedir>' %
+             sys.argv[0])
+
+  if sys.argv[1] == 'save':
+    Save(sys.argv[2], sys.argv[3:])
+  else:
+    Restore(sys.argv[2])
+
+
+if __name__ == '__main__':
+  main()
@@ -1,10 +1,180 @@
+import errno
+import json
+import multiprocessing
 import os
 import pwd
+import re
 import shutil
+import socket
+import struct
 import subprocess
 
+import snapshot
+
 SLAVENAME = open('/slave-name').read().strip()
 BASEDIR = os.path.join('/persistent-data', SLAVENAME)
+CACHEDIRS = [
+    '/persistent-data/ccache',
+    '/persistent-data/git-reference',
+]
+# Only the slaves listed under distcc_slaves in config.json run distccd.
+CONFIG_FILE = '/config/config.json'
+DISTCC_PORT = 3632
+# The networks other slaves' builds send compile jobs from.  By default the
+# networks this container is directly on, which is the slaves' network under
+# docker-compose.
+DISTCC_ALLOW = os.environ.get('DISTCC_ALLOW', '').split()
+# distccd only runs compilers with these names, found on the PATH.
+DISTCC_COMPILER_RE = re.compile(r'^([\w.-]+-)?(cc|c\+\+|gcc|g\+\+)(-[\d.]+)?$')
+
+
+def ReadFirstLine(path):
+  try:
+    with open(path) as fh:
+      return fh.readline().strip()
+  except IOError:
+    return None
+
+
+def UsableCpus():
+  cpus = multiprocessing.cpu_count()
+
+  # Respect a CPU quota set on the container, either through cgroup v1 or v2.
+  quota = ReadFirstLine('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+  period = ReadFirstLine('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+  cpu_max = ReadFirstLine('/sys/fs/cgroup/cpu.max')
+  if cpu_max is not None:
+    quota, period = cpu_max.split()
+  if quota not in (None, 'max', '-1') and period:
+    cpus = min(cpus, max(1, int(quota) // int(period)))
+  return cpus
+
+
+def UsableMemoryMb():
+  memory = None
+  with open('/proc/meminfo') as fh:
+    for line in fh:
+      if line.startswith('MemTotal:'):
+        memory = int(line.split()[1]) // 1024
+
+  for path in ['/sys/fs/cgroup/memory/memory.limit_in_bytes',
+               '/sys/fs/cgroup/memory.max']:
+    limit = ReadFirstLine(path)
+    if limit is not None and limit.isdigit():
+      memory = min(memory, int(limit) // (1024 * 1024))
+  return memory
+
+
+def Toolchain():
+  """Describes the compiler.  distcc only sends compile jobs to slaves with the
+  same toolchain, so the objects are the same as local ones.  The distro doesn't
+  matter: distcc preprocesses the sources locally and only sends the result."""
+  try:
+    machine = subprocess.check_output(['gcc', '-dumpmachine']).strip()
+    # -dumpversion only prints the major version since gcc 7.
+    version = subprocess.check_output(
+        ['gcc', '-dumpfullversion', '-dumpversion']).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+  return '%s gcc %s' % (machine, version)
+
+
+def LocalNetworks():
+  """Returns the networks this container has a direct route to."""
+  networks = []
+  with open('/proc/net/route') as fh:
+    for line in fh.readlines()[1:]:
+      fields = line.split()
+      destination, gateway, mask = [
+          struct.pack('<L', int(x, 16)) for x in (fields[1], fields[2],
+                                                  fields[7])]
+      if fields[0] == 'lo' or gateway != '\0' * 4 or mask == '\0' * 4:
+        continue
+      networks.append('%s/%d' % (socket.inet_ntoa(destination),
+                                 bin(struct.unpack('>L', mask)[0]).count('1')))
+  return networks
+
+
+def WriteDistccCommands(path):
+  """Lists the compilers distccd may run, in a file for DISTCC_CMDLIST."""
+  # distccd runs the first one with the name it was sent, like the shell would.
+  compilers = {}
+  for directory in reversed(os.environ.get('PATH', '').split(os.pathsep)):
+    if not os.path.isdir(directory):
+      continue
+    for name in os.listdir(directory):
+      if DISTCC_COMPILER_RE.match(name):
+        compilers[name] = os.path.join(directory, name)
+  with open(path, 'w') as fh:
+    fh.writelines('%s\n' % x for x in sorted(compilers.itervalues()))
+
+
+def DistccEnabled():
+  try:
+    with open(CONFIG_FILE) as fh:
+      config = json.load(fh)
+  except (IOError, ValueError):
+    return False
+  return SLAVENAME in config.get('distcc_slaves', [])
+
+
+def StartDistccd():
+  """Starts distccd in the background for other slaves' compile jobs, and
+  returns its address, or None if this slave doesn't take them, distcc isn't
+  installed or there are no networks to take jobs from."""
+  if not DistccEnabled():
+    return None
+  allow = DISTCC_ALLOW or LocalNetworks()
+  if not allow:
+    return None
+
+  # Anything that can reach distccd can run the commands it's sent, so it only
+  # runs the compilers, and only for the slaves' networks.
+  commands = os.path.join(BASEDIR, 'distcc-commands')
+  WriteDistccCommands(commands)
+  env = dict(os.environ, DISTCC_CMDLIST=commands, DISTCC_CMDLIST_NUMWORDS='1')
+  command = [
+      'distccd', '--daemon',
+      '--port', str(DISTCC_PORT),
+      '--jobs', str(UsableCpus()),
+      # This slave's own builds come first.
+      '--nice', '10',
+      '--log-file', os.path.join(BASEDIR, 'distccd.log'),
+  ]
+  for network in allow:
+    command += ['--allow', network]
+
+  try:
+    subprocess.check_call(command, env=env)
+  except (OSError, subprocess.CalledProcessError):
+    return None
+  return '%s:%d' % (socket.gethostbyname(socket.gethostname()), DISTCC_PORT)
+
+
+def WriteSlaveInfo(infodir):
+  # The master reads these when the slave connects and uses them to size the
+  # builds that run here.
+  if os.path.islink(infodir):
+    os.unlink(infodir)
+  if not os.path.exists(infodir):
+    os.mkdir(infodir)
+
+  for name in os.listdir('/config/slave/info'):
+    shutil.copy(os.path.join('/config/slave/info', name), infodir)
+
+  with open(os.path.join(infodir, 'cpus'), 'w') as fh:
+    fh.write('%d\n' % UsableCpus())
+  with open(os.path.join(infodir, 'memory'), 'w') as fh:
+    fh.write('%d\n' % UsableMemoryMb())
+
+  for name, value in [('toolchain', Toolchain()), ('distcc', StartDistccd())]:
+    path = os.path.join(infodir, name)
+    if value is not None:
+      with open(path, 'w') as fh:
+        fh.write(value + '\n')
+    elif os.path.exists(path):
+      os.unlink(path)
+
 
 pwd_entry = pwd.getpwnam('buildbot')
 creating_basedir = False
@@ -27,6 +197,16 @@ if not os.path.exists(BASEDIR):
     with open(os.path.join(BASEDIR, 'first-time-setup.log'), 'w') as fh:
       fh.write(stdout)
 
+# Create the caches that are shared between builders.
+for path in CACHEDIRS:
+  try:
+    os.mkdir(path)
+  except OSError as ex:
+    if ex.errno != errno.EEXIST:
+      raise
+  else:
+    os.chown(path, pwd_entry.pw_uid, pwd_entry.pw_gid)
+
 # Change to the buildbot user.
 os.setgid(pwd_entry.pw_gid)
 os.setuid(pwd_entry.pw_uid)
@@ -34,7 +214,12 @@ os.environ['HOME'] = pwd_entry.pw_dir
 
 if creating_basedir:
   os.symlink('/config/slave/buildbot.tac', os.path.join(BASEDIR, 'buildbot.tac'))
-  os.symlink('/config/slave/info', os.path.join(BASEDIR, 'info'))
+
+WriteSlaveInfo(os.path.join(BASEDIR, 'info'))
+
+# Bring back the builders' working copies if this slave lost its basedir.
+if snapshot.SNAPSHOT_SERVER:
+  snapshot.Restore(BASEDIR)
 
 pidfile = os.path.join(BASEDIR, 'twistd.pid')
 if os.path.exists(pidfile):
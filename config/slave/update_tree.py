@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# Makes a directory that's kept between builds match a freshly unpacked one,
+# only touching the files that changed, so make only rebuilds what depends on
+# them.
+#
+#   update_tree.py <unpacked dir> <kept dir> [kept subdir...]
+#
+# The kept subdirectories, like the build directory, are left alone.
+
+import filecmp
+import os
+import shutil
+import sys
+
+
+def Update(source, target, keep):
+  changed = 0
+  for dirpath, dirnames, filenames in os.walk(source):
+    relative = os.path.relpath(dirpath, source)
+    if relative == '.':
+      relative = ''
+    target_dir = os.path.join(target, relative)
+    if not os.path.isdir(target_dir):
+      if os.path.lexists(target_dir):
+        os.unlink(target_dir)
+      os.makedirs(target_dir)
+
+    # Symlinks to directories are copied as links, like the ones to files.
+    links = [x for x in dirnames if os.path.islink(os.path.join(dirpath, x))]
+    dirnames[:] = [x for x in dirnames if x not in links]
+    for name in filenames + links:
+      source_path = os.path.join(dirpath, name)
+      target_path = os.path.join(target_dir, name)
+      if os.path.islink(source_path):
+        link = os.readlink(source_path)
+        if (os.path.islink(target_path) and
+            os.readlink(target_path) == link):
+          continue
+        Remove(target_path)
+        os.symlink(link, target_path)
+      elif (os.path.isfile(target_path) and
+            not os.path.islink(target_path) and
+            filecmp.cmp(source_path, target_path, shallow=False)):
+        continue
+      else:
+        Remove(target_path)
+        shutil.copy2(source_path, target_path)
+      changed += 1
+
+    # Anything that's no longer in the sources goes.
+    wanted = set(dirnames) | set(filenames) | set(links)
+    for name in os.listdir(target_dir):
+      if name in wanted or (not relative and name in keep):
+        continue
+      Remove(os.path.join(target_dir, name))
+      changed += 1
+  return changed
+
+
+def Remove(path):
+  if os.path.isdir(path) and not os.path.islink(path):
+    shutil.rmtree(path)
+  elif os.path.lexists(path):
+    os.unlink(path)
+
+
+def main():
+  if len(sys.argv) < 3:
+    sys.exit('Usage: %s <unpacked dir> <kept dir> [kept subdir...]' %
+             sys.argv[0])
+  changed = Update(sys.argv[1], sys.argv[2], set(sys.argv[3:]))
+  print 'Updated %d files in %s' % (changed, sys.argv[2])
+
+
+if __name__ == '__main__':
+  main()
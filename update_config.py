@@ -9,6 +9,8 @@ import sys
 import yaml
 
 CONFIG = json.load(open('config/config.json'))
+# The master starts these slaves' containers itself when they have builds.
+LATENT_SLAVES = set(CONFIG.get('latent', {}).get('slaves', []))
 
 HEADER = '# This file is generated by update_config.py\n\n'
 
@@ -20,6 +22,9 @@ def Add(compose, name):
     'volumes': ['./config:/config'],
     'volumes_from': ['volumes'],
   }
+  if name[len('slave-'):] in LATENT_SLAVES:
+    # Only build the image, the container exits straight away.
+    compose[name]['command'] = '/bin/true'
 
 
 def CreatePassword():
@@ -49,6 +54,10 @@ def WriteComposeYaml():
     }
   }
 
+  if LATENT_SLAVES:
+    compose['master']['volumes'].append(
+        '/var/run/docker.sock:/var/run/docker.sock')
+
   for distro, versions in CONFIG['linux'].iteritems():
     for version in versions:
       for bits in [64, 32]: